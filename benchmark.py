@@ -0,0 +1,170 @@
+#!/usr/bin/python3
+
+# Copyright 2023 University of Twente
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Scaling benchmarks of the Profile Steering loop
+# Sweeps fleet size, fleet mix, horizon length and privacy scheme, and writes the results as JSON.
+# Every configuration runs in its own process, such that the privacy scheme (which is fixed at import time) can be
+# selected per run and the peak memory is measured per run.
+#
+# Usage examples:
+#   python benchmark.py                                       # full sweep
+#   python benchmark.py --devices 10 100 --intervals 96 --schemes HOMOMORPHIC --output results.json
+
+import argparse
+import datetime
+import itertools
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+DEVICES = [10, 100, 1000, 10000, 100000]
+INTERVALS = [96, 672, 2880, 35040]
+
+# Fraction of each device type in the fleet
+MIXES = {
+    "equal": {"load": 0.25, "battery": 0.25, "ev": 0.25, "heatpump": 0.25},  # like main.py
+    "residential": {"load": 0.6, "battery": 0.1, "ev": 0.15, "heatpump": 0.15},
+    "battery": {"battery": 1.0},
+    "ev": {"ev": 1.0},
+    "heatpump": {"heatpump": 1.0},
+}
+
+
+def _create_fleet(size: int, mix: dict[str, float]) -> list:
+    from dev.battery import Battery
+    from dev.electricvehicle import ElectricVehicle
+    from dev.heatpump import HeatPump
+    from dev.load import Load
+
+    types = {"load": Load, "battery": Battery, "ev": ElectricVehicle, "heatpump": HeatPump}
+    devices = []
+    for name, fraction in mix.items():
+        devices.extend(types[name]() for _ in range(round(size * fraction)))
+    return devices
+
+
+def _peak_memory() -> int | None:
+    """
+    Peak resident memory of this process
+    :return: peak memory in bytes, None if not available on this platform
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # bytes on macOS, kilobytes on Linux
+
+
+def run(config: dict) -> dict:
+    """
+    Runs a single configuration in this process
+    :param config: configuration, see main
+    :return: measurements
+    """
+    import numpy as np
+    from profilesteering import ProfileSteering
+
+    random.seed(config["seed"])
+    np.random.seed(config["seed"])
+
+    devices = _create_fleet(config["devices"], MIXES[config["mix"]])
+    ps = ProfileSteering(devices, **config["options"])
+
+    t1 = time.time()
+    ps.init([0] * config["intervals"])
+    t2 = time.time()
+    ps.iterative(config["e_min"], config["max_iters"])
+    t3 = time.time()
+    ps.close()
+
+    return {
+        "init_time": t2 - t1,
+        "aggregation_time": ps.aggregation_time,
+        "decryption_time": ps.decryption_time,
+        "iterative_time": t3 - t2,
+        "iteration_times": ps.iteration_times,
+        "iterations": ps.iterations,
+        "plan_calls": ps.plan_calls,
+        "objective": ps.objective,
+        "peak_memory": _peak_memory(),
+    }
+
+
+def _run_isolated(config: dict, timeout: float | None) -> dict:
+    env = dict(os.environ, PS_PRIVACY_SCHEME=config["scheme"])
+    try:
+        completed = subprocess.run([sys.executable, os.path.abspath(__file__), "--run", json.dumps(config)],
+                                   capture_output=True, text=True, env=env, timeout=timeout,
+                                   cwd=os.path.dirname(os.path.abspath(__file__)))
+    except subprocess.TimeoutExpired:
+        return {"status": "timeout"}
+
+    if completed.returncode != 0:
+        error = completed.stderr.strip().splitlines()
+        return {"status": "error", "error": error[-1] if error else "exit code %d" % completed.returncode}
+    return dict(json.loads(completed.stdout.strip().splitlines()[-1]), status="ok")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scaling benchmarks of the Profile Steering loop")
+    parser.add_argument("--devices", type=int, nargs="+", default=DEVICES, help="fleet sizes")
+    parser.add_argument("--intervals", type=int, nargs="+", default=INTERVALS, help="horizon lengths")
+    parser.add_argument("--mixes", nargs="+", default=list(MIXES), choices=list(MIXES), help="fleet mixes")
+    parser.add_argument("--schemes", nargs="+", default=["NONE", "HOMOMORPHIC", "DIFFERENTIAL"],
+                        help="privacy schemes, names of crypto.PrivacySchemes")
+    parser.add_argument("--e-min", type=float, default=0.001)
+    parser.add_argument("--max-iters", type=int, default=100)
+    parser.add_argument("--processes", type=int, default=None, help="see ProfileSteering")
+    parser.add_argument("--batched", action="store_true", help="see ProfileSteering")
+    parser.add_argument("--lazy", action="store_true", help="see ProfileSteering")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=None, help="maximum time per configuration in seconds")
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--run", help=argparse.SUPPRESS)  # internal: run a single configuration
+    args = parser.parse_args()
+
+    if args.run is not None:
+        print(json.dumps(run(json.loads(args.run))))
+        return
+
+    options = {"processes": args.processes, "batched": args.batched, "lazy": args.lazy}
+    results = []
+    for scheme, mix, intervals, devices in itertools.product(args.schemes, args.mixes, args.intervals, args.devices):
+        config = {"scheme": scheme, "mix": mix, "intervals": intervals, "devices": devices, "e_min": args.e_min,
+                  "max_iters": args.max_iters, "seed": args.seed, "options": options}
+        result = dict(config, **_run_isolated(config, args.timeout))
+        results.append(result)
+        print(scheme, mix, intervals, devices, "--", result["status"], round(result.get("init_time", 0), 3),
+              round(result.get("iterative_time", 0), 3))
+
+        # Write after every run, such that an interrupted sweep keeps its results
+        with open(args.output, "w") as f:
+            json.dump({
+                "created": datetime.datetime.now().isoformat(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "results": results,
+            }, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+#!/usr/bin/python3
+
+# Copyright 2023 University of Twente
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Equivalence check of the buffer planning kernels
+# The NumPy kernel (continuousBufferPlanningPositiveNumpy), its warm started variant (warmBufferPlanningPositive) and
+# the batched solver (BatchOptAlg.bufferPlanning) are compared with the original list-based code on seeded random
+# problems, including ties in the desired profile, power limits, and demands and capacities that split the horizon.
+# Planning merged intervals (intervalMerge) is compared with the problem in which every merged interval is repeated.
+# Exits with status 1 when a plan differs by more than the tolerance.
+#
+# Usage examples:
+#   python check_kernels.py
+#   python check_kernels.py --cases 3000 --seed 7 --tolerance 1e-9
+
+import argparse
+import random
+import sys
+
+import numpy as np
+
+from opt.batchAlg import BatchOptAlg
+from opt.optAlg import OptAlg, WarmStart
+
+
+def _desired(rng: random.Random, intervals: int) -> list[float]:
+    # Rounded values give many ties between the levels
+    if rng.random() < 0.5:
+        return [float(rng.randint(-5, 5)) for _ in range(intervals)]
+    return [rng.uniform(-10, 10) for _ in range(intervals)]
+
+
+def _perturb(rng: random.Random, desired: list[float]) -> list[float]:
+    # Only some intervals change between two plans of the same device, like in the steering loop
+    return [value + rng.uniform(-1, 1) if rng.random() < 0.1 else value for value in desired]
+
+
+def _difference(a, b) -> float:
+    return float(np.max(np.abs(np.asarray(a, dtype=np.float64) - np.asarray(b, dtype=np.float64)), initial=0.0))
+
+
+def check_positive(rng: random.Random) -> float:
+    """
+    Compares the NumPy and warm started kernels of continuousBufferPlanningPositive with the list-based kernel
+    :param rng: random generator
+    :return: largest difference between the plans
+    """
+    intervals = rng.choice([1, 2, 5, 24, 96])
+    powerMax = rng.choice([1.0, 3.7, 11.0])
+    limits = []
+    if rng.random() < 0.5:
+        limits = [rng.choice([0.0, powerMax / 2, rng.uniform(0, 2 * powerMax)]) for _ in range(intervals)]
+    chargeRequired = rng.uniform(-1, 1.1) * powerMax * intervals
+
+    opt = OptAlg()
+    warm = OptAlg()
+    warm.warmStartLength = 1  # warm start every length, the kernel itself does not depend on it
+    warmStart = WarmStart()
+
+    worst = 0.0
+    desired = _desired(rng, intervals)
+    for _ in range(3):
+        expected = opt.continuousBufferPlanningPositive(list(desired), chargeRequired, powerMax, list(limits))
+        numpy = opt.continuousBufferPlanningPositive(np.array(desired), chargeRequired, powerMax, list(limits))
+        warmed = warm.continuousBufferPlanningPositive(np.array(desired), chargeRequired, powerMax, list(limits),
+                                                       warmStart=warmStart)
+        worst = max(worst, _difference(expected, numpy), _difference(expected, warmed))
+        desired = _perturb(rng, desired)
+    return worst
+
+
+def check_buffer(rng: random.Random) -> float:
+    """
+    Compares bufferPlanning on NumPy input, with and without warm start, and the batched solver with bufferPlanning
+    on list input. Small capacities and demands split the horizon on SoC violations.
+    :param rng: random generator
+    :return: largest difference between the plans
+    """
+    intervals = rng.choice([2, 5, 24, 96])
+    devices = rng.randint(1, 4)
+    heatpump = rng.random() < 0.5  # heat pump: demand and no discharging, battery: no demand and discharging
+
+    problems = []
+    for _ in range(devices):
+        powerMax = rng.choice([1.0, 3.7, 11.0])
+        powerMin = 0.0 if heatpump else -powerMax
+        capacity = rng.uniform(0.5, 2 * intervals) * powerMax
+        demand = [rng.uniform(0, 1.5 * powerMax) for _ in range(intervals)] if heatpump else [0.0] * intervals
+        initialSoC = rng.uniform(0, capacity)
+        targetSoC = rng.uniform(0, capacity)
+        problems.append((_desired(rng, intervals), targetSoC, initialSoC, capacity, demand, powerMin, powerMax))
+
+    opt = OptAlg()
+    warm = OptAlg()
+    warm.warmStartLength = 1
+    warmStarts = [WarmStart() for _ in problems]
+
+    worst = 0.0
+    for _ in range(3):
+        expected = []
+        for (desired, targetSoC, initialSoC, capacity, demand, powerMin, powerMax), warmStart \
+                in zip(problems, warmStarts):
+            # bufferPlanning modifies its list arguments, hence they are created for every call
+            def arguments():
+                return targetSoC, initialSoC, capacity, list(demand), [], powerMin, powerMax, [], [], False, [], 1
+
+            plan = opt.bufferPlanning(list(desired), *arguments())
+            numpy = opt.bufferPlanning(np.array(desired), *arguments())
+            warmed = warm.bufferPlanning(np.array(desired), *arguments(), warmStart=warmStart)
+            worst = max(worst, _difference(plan, numpy), _difference(plan, warmed))
+            expected.append(plan)
+
+        columns = list(zip(*problems))
+        batched = BatchOptAlg().bufferPlanning(np.array(columns[0]), list(columns[1]), list(columns[2]),
+                                               list(columns[3]), np.array(columns[4]), list(columns[5]),
+                                               list(columns[6]))
+        worst = max(worst, _difference(expected, batched))
+        problems = [(_perturb(rng, problem[0]),) + problem[1:] for problem in problems]
+    return worst
+
+
+def check_merged(rng: random.Random) -> float:
+    """
+    Compares continuousBufferPlanning with intervalMerge with the expanded problem, in which every merged interval
+    is repeated, on the first interval of each merged interval
+    :param rng: random generator
+    :return: largest difference between the plans
+    """
+    intervals = rng.choice([1, 2, 5, 24, 96])
+    merge = [rng.choice([1, 2, 4, 12]) for _ in range(intervals)]
+    powerMax = rng.choice([1.0, 3.7, 11.0])
+    powerMin = rng.choice([0.0, -powerMax, -powerMax / 2])
+    lower, upper = [], []
+    if rng.random() < 0.3:
+        lower = [rng.choice([powerMin, rng.uniform(powerMin, powerMax)]) for _ in range(intervals)]
+        upper = [rng.choice([powerMax, rng.uniform(value, powerMax)]) for value in lower]
+    prices, beta = None, 1
+    if rng.random() < 0.3:
+        prices, beta = [rng.uniform(-5, 5) for _ in range(intervals)], rng.choice([0.5, 2.0])
+    chargeRequired = rng.uniform(powerMin - 0.1, powerMax + 0.1) * sum(merge)
+    desired = _desired(rng, intervals)
+
+    def expand(values):
+        return list(np.repeat(values, merge)) if values else values
+
+    opt = OptAlg()
+    merged = opt.continuousBufferPlanning(np.array(desired), chargeRequired, powerMin, powerMax, list(lower),
+                                          list(upper), prices=prices, beta=beta, intervalMerge=merge)
+    expanded = opt.continuousBufferPlanning(expand(desired), chargeRequired, powerMin, powerMax, expand(lower),
+                                            expand(upper), prices=expand(prices), beta=beta)
+    first = np.concatenate(([0], np.cumsum(merge)[:-1]))
+    return _difference(merged, np.asarray(expanded)[first])
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Equivalence check of the buffer planning kernels")
+    parser.add_argument("--cases", type=int, default=1000, help="number of random cases per check")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--tolerance", type=float, default=1e-6, help="largest allowed difference between plans")
+    args = parser.parse_args()
+
+    failed = False
+    for check in (check_positive, check_buffer, check_merged):
+        rng = random.Random(args.seed)
+        worst = 0.0
+        for case in range(args.cases):
+            difference = check(rng)
+            worst = max(worst, difference)
+            if difference > args.tolerance:
+                print("%s: case %d differs by %g" % (check.__name__, case, difference))
+                failed = True
+        print("%s: %d cases, largest difference %g" % (check.__name__, args.cases, worst))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+
+# Copyright 2023 University of Twente
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Receding horizon check
+# Steers a seeded fleet, then moves the window forward step by step with ProfileSteering.advance and steers again.
+# After every step the SoC of every buffer must lie within [0, capacity], and x must equal the sum of the profiles.
+# Exits with status 1 when a check fails.
+#
+# Usage examples:
+#   python check_receding.py
+#   python check_receding.py --devices 5 --steps 192 --seed 7
+
+import argparse
+import random
+import sys
+
+import numpy as np
+
+from dev.battery import Battery
+from dev.electricvehicle import ElectricVehicle
+from dev.heatpump import HeatPump
+from dev.load import Load
+from privacy import PlaintextBackend
+from profilesteering import ProfileSteering
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Receding horizon check")
+    parser.add_argument("--devices", type=int, default=3, help="number of devices of each type")
+    parser.add_argument("--intervals", type=int, default=96)
+    parser.add_argument("--steps", type=int, default=96, help="number of times the window is moved forward")
+    parser.add_argument("--step", type=int, default=1, help="number of intervals per step")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    devices = [Load() for _ in range(args.devices)] + [Battery() for _ in range(args.devices)] + \
+              [ElectricVehicle() for _ in range(args.devices)] + [HeatPump() for _ in range(args.devices)]
+
+    ps = ProfileSteering(devices, backend=PlaintextBackend())
+    ps.init([0] * args.intervals)
+    ps.iterative(0.001, 100)
+
+    failed = False
+    for step in range(args.steps):
+        ps.advance([0.0] * args.step)
+        ps.iterative(0.001, 100)
+
+        for index, device in enumerate(ps.devices):
+            if isinstance(device, Load):
+                continue
+            if not 0 <= device.initialSoC <= device.capacity:
+                print("step %d: %s %d has SoC %r outside [0, %r]"
+                      % (step, type(device).__name__, index, device.initialSoC, device.capacity))
+                failed = True
+        if not np.allclose(ps.x, sum(np.asarray(device.profile) for device in ps.devices)):
+            print("step %d: x differs from the sum of the profiles" % step)
+            failed = True
+
+    print("%d steps of %d interval(s), objective %g" % (args.steps, args.step, ps.objective))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,28 +1,193 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
 from enum import Enum
 
-from Pyfhel import Pyfhel
+import numpy as np
+from Pyfhel import Pyfhel, PyCtxt
 
 class PrivacySchemes(Enum):
     NONE = 1
     HOMOMORPHIC = 2
     DIFFERENTIAL = 3
 
-PRIVACY_SCHEME = PrivacySchemes.DIFFERENTIAL
+# Can be overridden with the PS_PRIVACY_SCHEME environment variable, e.g. PS_PRIVACY_SCHEME=HOMOMORPHIC
+PRIVACY_SCHEME = PrivacySchemes[os.environ.get("PS_PRIVACY_SCHEME", PrivacySchemes.DIFFERENTIAL.name)]
+
+CKKS_PARAMS = {
+    'scheme': 'CKKS',  # CKKS scheme supports floating point
+    'n': 2 ** 14,  # max length of ciphertext is n/2 -> 2**13 = 8192
+    'scale': 2 ** 30,  # scale factor for CKKS
+    'qi_sizes': [60, 30, 30, 30, 60]  # prime stuff idk
+}
+
+# Context and keys are saved here, such that every run and every worker process uses the same keyset.
+# Can be overridden with the PS_KEY_DIR environment variable.
+KEY_DIRECTORY = os.environ.get("PS_KEY_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "keys"))
+
+HE = Pyfhel()  # the context and keys are created on first use, see context()
+_has_keys = False
+_has_rotation_keys = False
+
+
+def _keyset_directory() -> str:
+    # One keyset per parameter set
+    return os.path.join(KEY_DIRECTORY, "ckks-%d-%d-%s" % (CKKS_PARAMS['n'], CKKS_PARAMS['scale'],
+                                                          "-".join(map(str, CKKS_PARAMS['qi_sizes']))))
+
+
+def context(rotations: bool = False) -> Pyfhel:
+    """
+    Returns HE with a CKKS context and keys, these are created on first use.
+    The keyset is loaded from the key directory, or generated and saved there when there is none yet.
+    :param rotations: whether rotation keys are needed as well
+    :return: HE
+    """
+    global _has_keys, _has_rotation_keys
+    directory = _keyset_directory()
+    if not _has_keys:
+        if not os.path.isfile(os.path.join(directory, "secret.key")):
+            HE.contextGen(**CKKS_PARAMS)
+            HE.keyGen()
+
+            # Save to a temporary directory that is moved in place at once.
+            # When another process was first, its keyset is used instead.
+            os.makedirs(KEY_DIRECTORY, exist_ok=True)
+            temporary = tempfile.mkdtemp(dir=KEY_DIRECTORY)
+            HE.save_context(os.path.join(temporary, "context"))
+            HE.save_public_key(os.path.join(temporary, "public.key"))
+            HE.save_secret_key(os.path.join(temporary, "secret.key"))
+            try:
+                os.rename(temporary, directory)
+            except OSError:
+                shutil.rmtree(temporary, ignore_errors=True)
+
+        HE.load_context(os.path.join(directory, "context"))
+        HE.load_public_key(os.path.join(directory, "public.key"))
+        HE.load_secret_key(os.path.join(directory, "secret.key"))
+        _has_keys = True
+
+    if rotations and not _has_rotation_keys:
+        path = os.path.join(directory, "rotate.key")
+        if os.path.isfile(path):
+            HE.load_rotate_key(path)
+        else:
+            HE.rotateKeyGen()
+            fd, temporary = tempfile.mkstemp(dir=directory)
+            os.close(fd)
+            HE.save_rotate_key(temporary)
+            os.replace(temporary, path)  # keys of concurrent processes are equally valid
+        _has_rotation_keys = True
+
+    return HE
 
-HE = Pyfhel()
-if PRIVACY_SCHEME == PrivacySchemes.HOMOMORPHIC:
-    ckks_params = {
-        'scheme': 'CKKS',  # CKKS scheme supports floating point
-        'n': 2 ** 14,  # max length of ciphertext is n/2 -> 2**13 = 8192
-        'scale': 2 ** 30,  # scale factor for CKKS
-        'qi_sizes': [60, 30, 30, 30, 60]  # prime stuff idk
-    }
-    HE.contextGen(**ckks_params)
-    HE.keyGen()
-    HE.rotateKeyGen()
 
 DifferentialOptions = {
     "scale": 200,
 }
 if PRIVACY_SCHEME == PrivacySchemes.DIFFERENTIAL:
-    pass
\ No newline at end of file
+    pass
+
+
+def encrypt_packed(profiles: list[np.ndarray]) -> list[PyCtxt]:
+    """
+    Encrypts profiles packed in the slots of as few ciphertexts as possible.
+    Profile i of a ciphertext occupies the slots [i * len(profile), (i + 1) * len(profile)).
+    :param profiles: profiles of equal length
+    :return: ciphertexts
+    """
+    he = context()
+    width = len(profiles[0])
+    blocks = he.get_nSlots() // width
+    if blocks < 1:
+        raise ValueError("A profile of %d intervals does not fit in %d slots" % (width, he.get_nSlots()))
+
+    return [he.encryptFrac(np.concatenate(profiles[start:start + blocks]).astype(np.float64))
+            for start in range(0, len(profiles), blocks)]
+
+
+def fold_packed(ctxt: PyCtxt, blocks: int, width: int) -> PyCtxt:
+    """
+    Sums the packed profiles of a ciphertext with rotations, the result is in the first width slots.
+    Uses the binary representation of blocks, such that about 2 * log2(blocks) rotations are needed.
+    :param ctxt: ciphertext with packed profiles
+    :param blocks: number of packed profiles
+    :param width: length of a profile
+    :return: ciphertext of which the first width slots hold the sum of the packed profiles
+    """
+    context(rotations=True)
+    result = None
+    partial = ctxt  # in every block position: sum of the next span blocks
+    span = 1
+    offset = 0  # blocks that are already summed into result
+    while blocks:
+        if blocks & 1:
+            part = partial if offset == 0 else partial << (offset * width)
+            result = part if result is None else result + part
+            offset += span
+        blocks >>= 1
+        if blocks:
+            partial = partial + (partial << (span * width))
+            span *= 2
+    return result
+
+
+_reduction_inputs = []  # ciphertexts that the forked workers of sum_ciphertexts inherit, so they are not pickled
+
+
+def _sum_range(bounds: tuple[int, int]) -> bytes:
+    """
+    Sums a contiguous range of _reduction_inputs in a worker process
+    :param bounds: start and end of the range, at least two ciphertexts
+    :return: serialized sum
+    """
+    start, end = bounds
+    total = _reduction_inputs[start] + _reduction_inputs[start + 1]  # new ciphertext, the inputs are left untouched
+    for ctxt in _reduction_inputs[start + 2:end]:
+        total += ctxt
+    return total.to_bytes()
+
+
+def _reduce_pairs(ciphertexts: list[PyCtxt]) -> PyCtxt:
+    """
+    Tree reduction with in-place additions, the ciphertexts are modified
+    :param ciphertexts: ciphertexts owned by the caller
+    :return: sum of the ciphertexts
+    """
+    while len(ciphertexts) > 1:
+        for i in range(0, len(ciphertexts) - 1, 2):
+            ciphertexts[i] += ciphertexts[i + 1]
+        ciphertexts = ciphertexts[::2]
+    return ciphertexts[0]
+
+
+def sum_ciphertexts(ciphertexts: list[PyCtxt], processes: int | None = None) -> PyCtxt:
+    """
+    Sums ciphertexts with a tree reduction, optionally spread over worker processes.
+    CKKS addition is exact modular arithmetic, so the result equals that of sum(ciphertexts).
+    :param ciphertexts: ciphertexts to sum, they are left untouched
+    :param processes: number of worker processes, None or 1 sums in this process.
+    Workers are forked such that they inherit the ciphertexts, platforms without fork sum in this process.
+    :return: sum of the ciphertexts
+    """
+    if len(ciphertexts) < 2:
+        return sum(ciphertexts)
+
+    processes = min(processes or 1, len(ciphertexts) // 2)
+    if processes > 1 and "fork" in multiprocessing.get_all_start_methods():
+        global _reduction_inputs
+        bounds = np.linspace(0, len(ciphertexts), processes + 1).astype(int)
+        _reduction_inputs = ciphertexts
+        try:
+            with multiprocessing.get_context("fork").Pool(processes) as pool:
+                partial_sums = pool.map(_sum_range, zip(bounds[:-1], bounds[1:]))
+        finally:
+            _reduction_inputs = []
+        return _reduce_pairs([PyCtxt(pyfhel=context(), bytestring=partial_sum) for partial_sum in partial_sums])
+
+    # The first level creates new ciphertexts, every level above adds in place
+    first = [ciphertexts[i] + ciphertexts[i + 1] for i in range(0, len(ciphertexts) - 1, 2)]
+    if len(ciphertexts) % 2:
+        first[-1] += ciphertexts[-1]
+    return _reduce_pairs(first)
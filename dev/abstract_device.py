@@ -1,30 +1,166 @@
+import time
 from abc import ABC, abstractmethod
 
 import numpy as np
 
-from crypto import PRIVACY_SCHEME, PrivacySchemes, HE, DifferentialOptions
+from privacy import PrivacyBackend
 from Pyfhel import PyCtxt
 
 
 class AbstractDevice(ABC):
+    # Subclasses declare their attributes in __slots__, such that large fleets fit in memory
+    __slots__ = ()
+
+    # Devices that never deviate from their initial planning set this to False
+    flexible = True
+
     @abstractmethod
-    def init(self, p: list[float]) -> PyCtxt:
+    def init(self, p: list[float]) -> np.ndarray:
         """
         Creates an initial planning for the device.
         :param p: Desired profile
-        :return: Encrypted sum of the planning
+        :return: Initial profile, see init_private for the representation that is sent to the aggregator
         """
         pass
 
+    def init_private(self, p: list[float], backend: PrivacyBackend) -> object:
+        """
+        Creates an initial planning for the device, like init.
+        :param p: Desired profile
+        :param backend: Privacy backend of the aggregator
+        :return: Private representation of the initial profile
+        """
+        return backend.encode(self.init(p))
+
     @abstractmethod
-    def plan(self, d: list[float]) -> float:
+    def shift(self, steps: int) -> np.ndarray:
         """
-        Requests a new candidate profile from the device.
+        Moves the device forward in time, for a receding horizon. The first intervals of the accepted profile are
+        executed and the state of the device is updated accordingly. The rest of the profile is kept as starting point
+        and the new intervals at the end are filled in.
+        :param steps: Number of intervals
+        :return: Profile over the new horizon, see shift_private for the representation that is sent to the aggregator
+        """
+        pass
+
+    def shift_private(self, steps: int, backend: PrivacyBackend) -> object:
+        """
+        Moves the device forward in time, like shift.
+        :param steps: Number of intervals
+        :param backend: Privacy backend of the aggregator
+        :return: Private representation of the profile over the new horizon
+        """
+        return backend.encode(self.shift(steps))
+
+    @abstractmethod
+    def plan_candidate(self, d: np.ndarray) -> None:
+        """
+        Plans a new candidate profile and stores it in the candidate attribute.
         :param d: Difference profile
+        :return: None
+        """
+        pass
+
+    def plan(self, d: list[float], d_norm: float | None = None) -> float:
+        """
+        Requests a new candidate profile from the device, and scores it.
+        :param d: Difference profile
+        :param d_norm: ||d||, which the aggregator calculates once per iteration for all devices.
+        Calculated when not given.
         :return: Improvement of the candidate profile
         """
+        d = np.asarray(d, dtype=np.float64)
+        self.plan_candidate(d)
+        return self.improvement(d, np.linalg.norm(d) if d_norm is None else d_norm)
+
+    def improvement(self, d: np.ndarray, d_norm: float) -> float:
+        """
+        Improvement ||x_m - p_m|| - ||^x_m - p_m|| of the candidate, with p_m = x_m - d.
+        The first term is ||d||. The second is expanded in inner products, such that no temporary profiles are needed,
+        and the difference of the norms is calculated as a difference of squares.
+        Uses the profile and candidate attributes that the devices keep.
+        :param d: Difference profile
+        :param d_norm: ||d||
+        :return: Improvement of the candidate profile
+        """
+        profile = self.profile
+        candidate = self.candidate
+        # ||d||^2 - ||^x_m - x_m + d||^2
+        difference = -(np.dot(candidate, candidate) - 2 * np.dot(candidate, profile) + np.dot(profile, profile)) \
+            - 2 * (np.dot(candidate, d) - np.dot(profile, d))
+        candidate_norm = np.sqrt(max(d_norm * d_norm - difference, 0.0))
+        if d_norm + candidate_norm == 0:
+            return 0.0
+        return float(difference / (d_norm + candidate_norm))
+
+    def is_flexible(self) -> bool:
+        """
+        Whether the device can change its profile after init.
+        Inflexible devices are not asked to plan in the iterative phase.
+        :return: True if the device has flexibility
+        """
+        return self.flexible
+
+    def set_interval_merge(self, intervalMerge: np.ndarray | None) -> None:
+        """
+        Sets the resolution at which the device plans its candidates, see resolution.py.
+        The candidates are still full-length profiles, constant within each merged interval.
+        Devices that cannot plan at a coarser resolution ignore this.
+        :param intervalMerge: intervalMerge vector of the horizon, None for full resolution
+        :return: None
+        """
         pass
 
+    @classmethod
+    def plan_batch(cls, devices: list["AbstractDevice"], d: list[float], d_norm: float | None = None) -> list[float]:
+        """
+        Requests a new candidate profile from several devices of this type at once.
+        Device types that can plan a whole group with one (vectorized) call override this.
+        :param devices: Devices of this type
+        :param d: Difference profile
+        :param d_norm: ||d||, calculated when not given
+        :return: Improvements of the candidate profiles, in the same order as the devices
+        """
+        if d_norm is None:
+            d_norm = np.linalg.norm(d)
+        return [device.plan(d, d_norm) for device in devices]
+
+    @staticmethod
+    def plan_grouped(devices: list["AbstractDevice"], d: list[float],
+                     latencies: dict[int, float] | None = None, d_norm: float | None = None) -> list[float]:
+        """
+        Requests a new candidate profile from all devices, using plan_batch for each device type.
+        :param devices: Devices
+        :param d: Difference profile
+        :param latencies: If given, the plan time of each group is stored in it, spread evenly over its devices
+        :param d_norm: ||d||, calculated when not given
+        :return: Improvements of the candidate profiles, in the same order as the devices
+        """
+        if d_norm is None:
+            d_norm = np.linalg.norm(d)
+        groups = {}
+        for index, device in enumerate(devices):
+            groups.setdefault(type(device), []).append(index)
+
+        improvements = [0.0] * len(devices)
+        for device_type, indices in groups.items():
+            t1 = time.perf_counter()
+            group_improvements = device_type.plan_batch([devices[i] for i in indices], d, d_norm)
+            for index, improvement in zip(indices, group_improvements):
+                improvements[index] = improvement
+            if latencies is not None:
+                latency = (time.perf_counter() - t1) / len(indices)
+                latencies.update((index, latency) for index in indices)
+        return improvements
+
+    def candidate_diff(self) -> np.ndarray:
+        """
+        Difference between the current candidate profile and the profile, without accepting the candidate.
+        Uses the profile and candidate attributes that the devices keep.
+        :return: Difference between the candidate profile and the profile
+        """
+        return np.subtract(self.candidate, self.profile)
+
     @abstractmethod
     def accept(self) -> PyCtxt | None:
         """
@@ -33,16 +169,11 @@ class AbstractDevice(ABC):
         """
         pass
 
-    @staticmethod
-    def calculate_private_representation(p: list[float]) -> tuple[list[float], list[float]] | PyCtxt:
+    def accept_private(self, backend: PrivacyBackend) -> object:
         """
-        Calculates the private representation of a profile.
-        :param p: Profile
-        :return: Private representation of the profile
+        Accepts the current candidate profile, like accept, for aggregators that keep a private aggregate up to date.
+        :param backend: Privacy backend of the aggregator
+        :return: Private representation of the difference between the current candidate profile and the previous
+        profile.
         """
-
-        if PRIVACY_SCHEME == PrivacySchemes.HOMOMORPHIC:
-            return HE.encryptFrac(np.array(p, dtype=np.float64))
-        elif PRIVACY_SCHEME == PrivacySchemes.DIFFERENTIAL:
-            return list(np.array(p, dtype=np.float64) + np.random.laplace(0, DifferentialOptions['scale'], len(p))), p
-        pass
\ No newline at end of file
+        return backend.encode_update(np.asarray(self.accept(), dtype=np.float64))
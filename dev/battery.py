@@ -12,67 +12,117 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import operator
 import numpy as np
 import opt.optAlg
+import opt.batchAlg
 
 from dev.abstract_device import AbstractDevice
+from resolution import expand_profile, merge_profile
 from Pyfhel import PyCtxt
 
 
 class Battery(AbstractDevice):
+    __slots__ = ('profile', 'candidate', 'warmStart', 'capacity', 'max_power', 'min_power', 'initialSoC',
+                 'targetSoC', 'intervalMerge')
+
+    # The optimization library is shared by all devices, it keeps no state that is used between calls
+    opt = opt.optAlg.OptAlg()
+
     def __init__(self):
-        self.profile = []  # x_m in the PS paper
-        self.candidate = []  # ^x_m in the PS paper
+        self.profile = np.zeros(0)  # x_m in the PS paper
+        self.candidate = np.zeros(0)  # ^x_m in the PS paper, buffer that is reused for every plan
+        self.warmStart = opt.optAlg.WarmStart()  # state of the previous plan, to warm start the next one
+        self.intervalMerge = None  # resolution of the planning, see set_interval_merge
 
         # Device specific params
         self.capacity = 14000
         self.max_power = 5000
         self.min_power = -5000
         self.initialSoC = 0.5 * self.capacity
+        self.targetSoC = self.initialSoC  # SoC at the end of the horizon
 
-        # Importing the optimization library
-        self.opt = opt.optAlg.OptAlg()
-
-    def init(self, p: list[float]) -> PyCtxt | list[float]:
+    def init(self, p: list[float]) -> np.ndarray:
         # Create an initial planning.
         # Since we do not know what the rest of the appliances do, we can just fill it with zeroes:
-        self.profile = [0] * len(p)
-        return self.calculate_private_representation(self.profile)
+        self.profile = np.zeros(len(p))
+        self.candidate = np.zeros(len(p))
+        return self.profile
+
+    def is_flexible(self) -> bool:
+        # Without power range or storage the planning is fixed
+        return self.capacity > 0 and self.max_power > self.min_power
+
+    def shift(self, steps: int) -> np.ndarray:
+        # The battery is charged with the first intervals of the profile
+        # Clamped to the capacity, such that rounding errors do not add up over many steps
+        self.initialSoC = min(max(self.initialSoC + float(np.sum(self.profile[:steps])), 0.0), self.capacity)
 
-    def plan(self, d: list[float]) -> float:
+        # The new intervals are idle, such that the battery still ends at the target SoC
+        self.profile = np.concatenate((self.profile[steps:], np.zeros(steps)))
+        self.candidate = self.profile.copy()
+        self.warmStart.shift(steps, len(self.profile), len(self.profile))
+        return self.profile
+
+    def set_interval_merge(self, intervalMerge: np.ndarray | None) -> None:
+        self.intervalMerge = intervalMerge
+
+    def plan_candidate(self, d: np.ndarray) -> None:
         # desired is "d" in the PS paper
-        p_m = list(map(operator.sub, self.profile, d))  # p_m = x_m - d
+        p_m = self.profile - d  # p_m = x_m - d
 
         # Call the magic
         # Function prototype:
         # bufferPlanning(	self, desired, targetSoC, initialSoC, capacity, demand, chargingPowers, powerMin = 0, powerMax = 0,
         #					powerLimitsLower = [], powerLimitsUpper = [], reactivePower = False, prices = [], profileWeight = 1)
 
-        self.candidate = self.opt.bufferPlanning(p_m,
-                                                 self.initialSoC,
-                                                 self.initialSoC,
-                                                 self.capacity,
-                                                 [0] * len(p_m),  # Static losses, not used
-                                                 [], self.min_power, self.max_power,
-                                                 [], [],
-                                                 False,
-                                                 [],
-                                                 1)
+        # At a coarser resolution the device plans the average of p_m over each merged interval
+        merge = self.intervalMerge
+        desired = p_m if merge is None else merge_profile(p_m, merge)
+
+        profile = self.opt.bufferPlanning(desired,
+                                          self.targetSoC,
+                                          self.initialSoC,
+                                          self.capacity,
+                                          [0] * len(desired),  # Static losses, not used
+                                          [], self.min_power, self.max_power,
+                                          [], [],
+                                          False,
+                                          [],
+                                          1,
+                                          intervalMerge=merge,
+                                          warmStart=self.warmStart)
+        self.candidate[:] = profile if merge is None else expand_profile(profile, merge)
         # We set the target equal to the initial SoC. Note that more clever options based on the desired profile are possible!!!
+        # The improvement is calculated by AbstractDevice.improvement
+
+    @classmethod
+    def plan_batch(cls, devices: list["Battery"], d: list[float], d_norm: float | None = None) -> list[float]:
+        # The batched solver does not support merged intervals
+        if any(device.intervalMerge is not None for device in devices):
+            return super().plan_batch(devices, d, d_norm)
+
+        # Plan all devices at once with the batched solver, the device parameters may differ per device
+        profiles = np.array([device.profile for device in devices], dtype=np.float64)
+        p_m = profiles - np.asarray(d, dtype=np.float64)  # p_m = x_m - d
+
+        batch = opt.batchAlg.BatchOptAlg()
+        candidates = batch.bufferPlanning(p_m,
+                                          [device.targetSoC for device in devices],
+                                          [device.initialSoC for device in devices],
+                                          [device.capacity for device in devices],
+                                          None,
+                                          [device.min_power for device in devices],
+                                          [device.max_power for device in devices])
 
-        # Calculate the improvement by this device:
-        e_m = np.linalg.norm(np.array(self.profile) - np.array(p_m)) - np.linalg.norm(
-            np.array(self.candidate) - np.array(p_m))
+        for device, candidate in zip(devices, candidates):
+            device.candidate[:] = candidate
 
-        # Return the improvement
-        # print("Improvement: ", self, e_m)
-        return e_m
+        return batch.improvements(profiles, candidates, d, d_norm).tolist()
 
     def accept(self) -> PyCtxt | list[float] | None:
         # We are chosen as winner, replace the profile:
-        diff = list(map(operator.sub, self.candidate, self.profile))
-        self.profile = list(self.candidate)
+        diff = self.candidate - self.profile
+        self.profile[:] = self.candidate
 
         # Note we can send the difference profile only as incremental update
         return diff
@@ -12,20 +12,36 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import operator
 import random
+from collections import OrderedDict
+
 import numpy as np
 import opt.optAlg
 
 from dev.abstract_device import AbstractDevice
 from crypto import HE
 from Pyfhel import PyCtxt
+from resolution import expand_profile, merge_profile, window_merge
+from sparse import SparseProfile, sparse_improvement
 
 
 class ElectricVehicle(AbstractDevice):
+    __slots__ = ('profile', 'candidate', 'warmStart', 'cache', 'intervalLength', 'capacity', 'powers', 'discrete',
+                 'startTime', 'endTime', 'chargeRequest', 'initialSoC', 'intervalMerge')
+
+    # The optimization library is shared by all devices, it keeps no state that is used between calls
+    opt = opt.optAlg.OptAlg()
+
+    # Number of candidates that are kept per EV, see plan
+    cacheSize = 4
+
     def __init__(self):
-        self.profile = []  # x_m in the PS paper
-        self.candidate = []  # ^x_m in the PS paper
+        # Both are only stored within the connection window, see init
+        self.profile = SparseProfile(0)  # x_m in the PS paper
+        self.candidate = SparseProfile(0)  # ^x_m in the PS paper, buffer that is reused for every plan
+        self.warmStart = opt.optAlg.WarmStart()  # state of the previous plan, to warm start the next one
+        self.cache = OrderedDict()  # planned profile of the connection window, keyed on p_m within the window
+        self.intervalMerge = None  # resolution of the planning within the connection window, see set_interval_merge
 
         # Intervallength in seonds
         self.intervalLength = 900
@@ -51,77 +67,129 @@ class ElectricVehicle(AbstractDevice):
         assert (self.initialSoC >= 0)
         # Note: Ensure that the EV can be charged in time! (time in hours * maximum charge power!)
 
-        # Importing the optimization library
-        self.opt = opt.optAlg.OptAlg()
-
-    def init(self, p: list[float]) -> PyCtxt:
+    def init(self, p: list[float]) -> np.ndarray:
         # Create an initial planning.
-        # Need to set the initial profile to get the correct length:
-        self.profile = [0] * len(p)
+        # The profile is zero outside the connection window, so only the window is stored:
+        offset = min(self.startTime, len(p))
+        width = max(0, min(self.endTime, len(p)) - offset)
+        self.profile = SparseProfile(len(p), offset, np.zeros(width))
+        self.candidate = SparseProfile(len(p), offset, np.zeros(width))
 
         # We can use the planning function in a local fashion with a zero profile to get a plan
         # Another option would be to use a greedy strategy to plan the profile with greedy charging: asap
         self.plan(p)  # Create an initial plan
         self.accept()  # Accept it, such that self.profile is set
 
-        return self.calculate_private_representation(self.profile)
+        return np.asarray(self.profile)
+
+    def is_flexible(self) -> bool:
+        # An EV that is never connected, or that has left already, cannot be planned
+        return self.endTime > max(self.startTime, 0)
+
+    def shift(self, steps: int) -> np.ndarray:
+        profile = self.profile
+        length = profile.length
+
+        # The EV is charged with the intervals of its window that are executed
+        delivered = float(np.sum(profile.values[:max(0, steps - profile.offset)]))
+        # Clamped to the capacity, such that rounding errors do not add up over many steps
+        self.initialSoC = min(max(self.initialSoC + delivered, 0.0), self.capacity)
+        self.chargeRequest = max(self.chargeRequest - delivered / int(3600 / self.intervalLength), 0.0)
+
+        # Connection and departure times are relative to the start of the horizon
+        self.startTime -= steps
+        self.endTime -= steps
+
+        # The window keeps the rest of the profile, new intervals at the end of the horizon are idle
+        offset = min(max(self.startTime, 0), length)
+        width = max(0, min(self.endTime, length) - offset)
+        values = np.zeros(width)
+        kept = profile.values[max(0, offset + steps - profile.offset):][:width]
+        values[:len(kept)] = kept
+
+        self.warmStart.shift(offset + steps - profile.offset, len(profile.values), width)
+        self.cache.clear()  # the SoC changed, so the cached plans are no longer valid
+        self.intervalMerge = None  # the resolution was set for the previous horizon
+        self.profile = SparseProfile(length, offset, values)
+        self.candidate = SparseProfile(length, offset, values.copy())
+        return np.asarray(self.profile)
+
+    def set_interval_merge(self, intervalMerge: np.ndarray | None) -> None:
+        # Merged intervals that cross the connection times are cut off
+        window = self.profile.window
+        self.intervalMerge = None if intervalMerge is None else window_merge(intervalMerge, window.start, window.stop)
 
     # Receiving a plan request from the Profile Steering algorithm
-    def plan(self, d: list[float]) -> float:
+    def plan_candidate(self, d: np.ndarray) -> None:
         # desired is "d" in the PS paper
-        p_m = list(map(operator.sub, self.profile, d))  # p_m = x_m - d
+        p_m = self.profile.values - d[self.profile.window]  # p_m = x_m - d, within the connection window
+
+        # At a coarser resolution the EV plans the average of p_m over each merged interval
+        merge = self.intervalMerge
+        if merge is not None:
+            p_m = merge_profile(p_m, merge)
 
-        # Call the magic
+        # The planning only depends on p_m within the connection window, which often did not change since the
+        # previous plan because the winners acted on other intervals. Least recently used entries are evicted.
+        key = p_m.tobytes() if merge is None else p_m.tobytes() + merge.tobytes()
+        profile = self.cache.get(key)
+        if profile is not None:
+            self.cache.move_to_end(key)  # Cache hit, no need to call the magic
 
         # CONTINUOUS VARIANT
-        if not self.discrete:
+        elif not self.discrete:
             # Function prototype:
             # bufferPlanning(	self, desired, targetSoC, initialSoC, capacity, demand, chargingPowers, powerMin = 0, powerMax = 0,
             #					powerLimitsLower = [], powerLimitsUpper = [], reactivePower = False, prices = [], profileWeight = 1)
 
-            profile = self.opt.bufferPlanning(p_m[self.startTime:self.endTime],
+            profile = self.opt.bufferPlanning(p_m,
                                               self.capacity,
                                               self.initialSoC,
                                               self.capacity,
-                                              [0] * len(p_m[self.startTime:self.endTime]),  # Static losses, not used
+                                              [0] * len(p_m),  # Static losses, not used
                                               [], self.powers[0], self.powers[1],
                                               [], [],
                                               False,
                                               [],
-                                              1)
+                                              1,
+                                              intervalMerge=merge,
+                                              warmStart=self.warmStart)
         # We set the target equal to the initial SoC. Note that more clever options based on the desired profile are possible!!!
 
         # DISCRETE VARIANT:
         else:
             # Function prototype:
             # discreteBufferPlanningPositive(self, desired, chargeRequired, chargingPowers, powerLimitsUpper = [], prices = None, beta = 1):
-            profile = self.opt.discreteBufferPlanningPositive(p_m[self.startTime:self.endTime],
+            profile = self.opt.discreteBufferPlanningPositive(p_m,
                                                               # We only need the section at which the EV is connected
                                                               self.chargeRequest * int(3600 / self.intervalLength),
                                                               # We need to convert this in "wattTau" instead of WattHours.
                                                               self.powers,
                                                               [],
                                                               None,
-                                                              1)
+                                                              1,
+                                                              intervalMerge=merge)
+
+        if key not in self.cache:
+            profile = self.cache[key] = np.asarray(profile, dtype=np.float64)
+            if len(self.cache) > self.cacheSize:
+                self.cache.popitem(last=False)
 
-        self.candidate = [0] * len(p_m)  # Create an empty vector
-        # Now add the optimized profile at the right indices of the vector
-        for i in range(self.startTime, self.endTime):
-            self.candidate[i] = profile[i - self.startTime]
+        # The candidate is zero outside the connection window as well
+        self.candidate.values[:] = profile if merge is None else expand_profile(profile, merge)
 
-        # Calculate the improvement by this device:
-        e_m = np.linalg.norm(np.array(self.profile) - np.array(p_m)) - np.linalg.norm(
-            np.array(self.candidate) - np.array(p_m))
+    def improvement(self, d: np.ndarray, d_norm: float) -> float:
+        # Only the connection window and ||d|| are needed
+        return sparse_improvement(d, self.profile, self.candidate, d_norm)
 
-        # Return the improvement
-        # print("Improvement: ", self, e_m)
-        return e_m
+    def candidate_diff(self) -> SparseProfile:
+        return SparseProfile(self.profile.length, self.profile.offset, self.candidate.values - self.profile.values)
 
     # Accept a profile
-    def accept(self) -> PyCtxt | None:
+    def accept(self) -> PyCtxt | SparseProfile | None:
         # We are chosen as winner, replace the profile:
-        diff = list(map(operator.sub, self.candidate, self.profile))
-        self.profile = list(self.candidate)
+        diff = self.candidate_diff()
+        self.profile.values[:] = self.candidate.values
 
         # Note we can send the difference profile only as incremental update
         return diff
@@ -12,10 +12,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import operator
 import random
 import numpy as np
 import opt.optAlg
+import opt.batchAlg
 
 from dev.abstract_device import AbstractDevice
 from crypto import HE
@@ -23,70 +23,109 @@ from Pyfhel import PyCtxt
 
 
 class HeatPump(AbstractDevice):
+    __slots__ = ('profile', 'candidate', 'warmStart', 'heatdemand', 'capacity', 'max_power', 'min_power',
+                 'initialSoC', 'targetSoC')
+
+    # The optimization library is shared by all devices, it keeps no state that is used between calls
+    opt = opt.optAlg.OptAlg()
+
     def __init__(self):
-        self.profile = []  # x_m in the PS paper
-        self.candidate = []  # ^x_m in the PS paper
+        self.profile = np.zeros(0)  # x_m in the PS paper
+        self.candidate = np.zeros(0)  # ^x_m in the PS paper, buffer that is reused for every plan
+        self.warmStart = opt.optAlg.WarmStart()  # state of the previous plan, to warm start the next one
 
         # Device specific params
         self.capacity = 14000  # in Wtau, converted in electricity equivalent
         self.max_power = 5000  # in W, electricity
         self.min_power = 0
         self.initialSoC = 0.5 * self.capacity
+        self.targetSoC = self.initialSoC  # SoC at the end of the horizon
 
-        # Importing the optimization library
-        self.opt = opt.optAlg.OptAlg()
-
-    def init(self, p: list[float]) -> PyCtxt:
+    def init(self, p: list[float]) -> np.ndarray:
         # Heat demand
         # We create a random list of power values, but it can be any list
-        self.heatdemand = []
-        for i in range(0, len(p)):
-            self.heatdemand.append(self.max_power * 1.5 * random.random())
+        self.heatdemand = np.array([self.max_power * 1.5 * random.random() for i in range(0, len(p))])
 
         # Create an initial planning.
         # Need to set the initial profile to get the correct length:
-        self.profile = [0] * len(p)
+        self.profile = np.zeros(len(p))
+        self.candidate = np.zeros(len(p))
 
         # We can use the planning function in a local fashion with a zero profile to get a plan
         # Another option would be to use a greedy strategy to plan the profile with greedy charging: asap
         self.plan(p)  # Create an initial plan
         self.accept()  # Accept it, such that self.profile is set
 
-        return self.calculate_private_representation(self.profile)
-
-    def plan(self, d: list[float]) -> float:
+        return self.profile
+
+    def is_flexible(self) -> bool:
+        # Without power range or storage the heat demand has to be followed exactly
+        return self.capacity > 0 and self.max_power > self.min_power
+
+    def shift(self, steps: int) -> np.ndarray:
+        # The buffer is charged with the first intervals of the profile and discharged by the heat demand.
+        # Clamped to the capacity, such that rounding errors do not add up over many steps.
+        soc = self.initialSoC + float(np.sum(self.profile[:steps]) - np.sum(self.heatdemand[:steps]))
+        self.initialSoC = min(max(soc, 0.0), self.capacity)
+
+        # The heat demand of the new intervals is drawn like in init, the heat pump follows it there.
+        # Then the buffer still ends at the target SoC, as far as the power limits allow.
+        tail = np.array([self.max_power * 1.5 * random.random() for i in range(0, steps)])
+        self.heatdemand = np.concatenate((self.heatdemand[steps:], tail))
+        self.profile = np.concatenate((self.profile[steps:], np.clip(tail, self.min_power, self.max_power)))
+        self.candidate = self.profile.copy()
+        self.warmStart.shift(steps, len(self.profile), len(self.profile))
+        return self.profile
+
+    def plan_candidate(self, d: np.ndarray) -> None:
+        # Always planned at full resolution: the heat demand varies within merged intervals, so a constant power per
+        # merged interval could empty or overfill the buffer within it (see AbstractDevice.set_interval_merge).
         # desired is "d" in the PS paper
-        p_m = list(map(operator.sub, self.profile, d))  # p_m = x_m - d
+        p_m = self.profile - d  # p_m = x_m - d
 
         # Call the magic
         # Function prototype:
         # bufferPlanning(	self, desired, targetSoC, initialSoC, capacity, demand, chargingPowers, powerMin = 0, powerMax = 0,
         #					powerLimitsLower = [], powerLimitsUpper = [], reactivePower = False, prices = [], profileWeight = 1)
 
-        self.candidate = self.opt.bufferPlanning(p_m,
-                                                 self.initialSoC,
-                                                 self.initialSoC,
-                                                 self.capacity,
-                                                 self.heatdemand,
-                                                 [], self.min_power, self.max_power,
-                                                 [], [],
-                                                 False,
-                                                 [],
-                                                 1)
+        self.candidate[:] = self.opt.bufferPlanning(p_m,
+                                                    self.targetSoC,
+                                                    self.initialSoC,
+                                                    self.capacity,
+                                                    self.heatdemand,
+                                                    [], self.min_power, self.max_power,
+                                                    [], [],
+                                                    False,
+                                                    [],
+                                                    1,
+                                                    warmStart=self.warmStart)
         # We set the target equal to the initial SoC. Note that more clever options based on the desired profile are possible!!!
+        # The improvement is calculated by AbstractDevice.improvement
+
+    @classmethod
+    def plan_batch(cls, devices: list["HeatPump"], d: list[float], d_norm: float | None = None) -> list[float]:
+        # Plan all devices at once with the batched solver, the device parameters may differ per device
+        profiles = np.array([device.profile for device in devices], dtype=np.float64)
+        p_m = profiles - np.asarray(d, dtype=np.float64)  # p_m = x_m - d
+
+        batch = opt.batchAlg.BatchOptAlg()
+        candidates = batch.bufferPlanning(p_m,
+                                          [device.targetSoC for device in devices],
+                                          [device.initialSoC for device in devices],
+                                          [device.capacity for device in devices],
+                                          [device.heatdemand for device in devices],
+                                          [device.min_power for device in devices],
+                                          [device.max_power for device in devices])
 
-        # Calculate the improvement by this device:
-        e_m = np.linalg.norm(np.array(self.profile) - np.array(p_m)) - np.linalg.norm(
-            np.array(self.candidate) - np.array(p_m))
+        for device, candidate in zip(devices, candidates):
+            device.candidate[:] = candidate
 
-        # Return the improvement
-        # print("Improvement: ", self, e_m)
-        return e_m
+        return batch.improvements(profiles, candidates, d, d_norm).tolist()
 
     def accept(self) -> PyCtxt | None:
         # We are chosen as winner, replace the profile:
-        diff = list(map(operator.sub, self.candidate, self.profile))
-        self.profile = list(self.candidate)
+        diff = self.candidate - self.profile
+        self.profile[:] = self.candidate
 
         # Note we can send the difference profile only as incremental update
         return diff
\ No newline at end of file
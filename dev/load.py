@@ -12,7 +12,6 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import operator
 import random
 import numpy as np
 
@@ -22,39 +21,44 @@ from crypto import HE
 
 
 class Load(AbstractDevice):
+    __slots__ = ('profile', 'candidate', 'max')
+
+    # A baseload offers no flex
+    flexible = False
+
     def __init__(self):
-        self.profile = []  # x_m in the PS paper
-        self.candidate = []  # ^x_m in the PS paper
+        self.profile = np.zeros(0)  # x_m in the PS paper
+        self.candidate = self.profile  # ^x_m in the PS paper
 
         # Device specific params
         self.max = 5000
 
-    def init(self, p: list[float]) -> PyCtxt:
+    def init(self, p: list[float]) -> np.ndarray:
         # Create a baseload for a given number of intervals
-        self.profile = []  # Empty the profile
-
         # We create a random list of power values, but it can be any list
-        for i in range(0, len(p)):
-            self.profile.append(self.max * random.random())
+        self.profile = np.array([self.max * random.random() for i in range(0, len(p))])
+        self.candidate = self.profile
 
-        return self.calculate_private_representation(self.profile)
+        return self.profile
 
-    def plan(self, d: list[float]) -> float:
-        assert (len(d) == len(self.profile))
-        p_m = list(map(operator.sub, self.profile, d))  # p_m = x_m - d
+    def shift(self, steps: int) -> np.ndarray:
+        # The new intervals are drawn like in init
+        tail = np.array([self.max * random.random() for i in range(0, steps)])
+        self.profile = np.concatenate((self.profile[steps:], tail))
+        self.candidate = self.profile
+
+        return self.profile
 
-        self.candidate = list(self.profile)  # A baseload offers no flex, so we can just return the profile
-        # Note that we need to create a new list due to "hidden pointers" in Python
+    def plan_candidate(self, d: np.ndarray) -> None:
+        assert (len(d) == len(self.profile))
 
-        # Calculate the improvement by this device:
-        e_m = np.linalg.norm(np.array(self.profile) - np.array(p_m)) - np.linalg.norm(
-            np.array(self.candidate) - np.array(p_m))
+        # A baseload offers no flex, so the candidate is always the profile itself (no copy needed)
+        self.candidate = self.profile
 
-        # Return the improvement
-        # Note that e_m should be 0 for a static device
-        # print("Improvement: ", self, e_m)
-        return e_m
+    def improvement(self, d: np.ndarray, d_norm: float) -> float:
+        # Hence the improvement by this device is always 0
+        return 0.0
 
     def accept(self) -> PyCtxt | None:
-        # We are chosen as winner, replace the profile:
-        self.profile = list(self.candidate)
+        # We are chosen as winner, the candidate is the profile, so nothing changes
+        return np.zeros(len(self.profile))
@@ -0,0 +1,299 @@
+# Copyright 2023 University of Twente
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import multiprocessing
+import time
+import traceback
+import weakref
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from dev.abstract_device import AbstractDevice
+from privacy import PrivacyBackend
+
+
+class RemoteTraceback(Exception):
+    """
+    Traceback of an exception raised in a worker process, set as the cause of the exception in the coordinator
+    """
+
+    def __str__(self) -> str:
+        return self.args[0]
+
+
+class _Failure:
+    """
+    Exception raised while executing a command in a worker, sent to the coordinator instead of the result
+    """
+
+    def __init__(self, exception: BaseException, tb: str):
+        self.exception = exception
+        self.tb = tb
+
+
+def _execute(devices: list[AbstractDevice], active: list[int], d: np.ndarray, batched: bool, command: str,
+             arg) -> object:
+    """
+    Executes a command of the coordinator
+    :param devices: devices owned by this worker
+    :param active: local indices of the devices that are planned, updated by the flexible command
+    :param d: difference profile, in shared memory
+    :param batched: plan devices of the same type together with their plan_batch implementation
+    :param command: command of the coordinator
+    :param arg: argument of the command
+    :return: result that is sent to the coordinator
+    """
+    if command == "plan":
+        # The argument tells whether the plan time of each device is measured, and holds ||d||
+        measure, d_norm = arg
+        latencies = {} if measure else None
+        planned = [devices[j] for j in active]
+        if batched:
+            improvements = AbstractDevice.plan_grouped(planned, d, latencies, d_norm)
+        else:
+            improvements = []
+            for index, device in enumerate(planned):
+                t1 = time.perf_counter()
+                improvements.append(device.plan(d, d_norm))
+                if latencies is not None:
+                    latencies[index] = time.perf_counter() - t1
+        return improvements, latencies
+    elif command == "diff":
+        return devices[arg].candidate_diff()
+    elif command == "accept":
+        return devices[arg].accept()
+    elif command == "accept_private":
+        index, backend = arg
+        return backend.serialize(devices[index].accept_private(backend))
+    elif command == "flexible":
+        active[:] = [j for j, device in enumerate(devices) if device.is_flexible()]
+        return active
+    elif command == "shift_private":
+        steps, backend = arg
+        return [backend.serialize(device.shift_private(steps, backend)) for device in devices]
+    elif command == "interval_merge":
+        for j in active:
+            devices[j].set_interval_merge(arg)
+        return None
+    raise ValueError("Unknown command %r" % command)
+
+
+def _worker(devices: list[AbstractDevice], shm_name: str, intervals: int, batched: bool, conn) -> None:
+    """
+    Main loop of a worker process, owns a contiguous slice of the devices
+    :param devices: devices owned by this worker
+    :param shm_name: name of the shared memory block that holds the difference profile
+    :param intervals: number of intervals in the difference profile
+    :param batched: plan devices of the same type together with their plan_batch implementation
+    :param conn: pipe to the coordinator
+    :return: None
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    d = np.ndarray((intervals,), dtype=np.float64, buffer=shm.buf)
+    active = list(range(len(devices)))
+    try:
+        while True:
+            command, arg = conn.recv()
+            if command == "close":
+                conn.send(devices)
+                break
+            try:
+                result = _execute(devices, active, d, batched, command, arg)
+            except Exception as e:
+                # The worker keeps running, such that the coordinator can still close the pool
+                result = _Failure(e, traceback.format_exc())
+            try:
+                conn.send(result)
+            except Exception as e:
+                # The result or the exception can not be pickled
+                conn.send(_Failure(RuntimeError(repr(e)), traceback.format_exc()))
+    finally:
+        del d
+        shm.close()
+
+
+class DevicePool:
+    """
+    Keeps the devices in persistent worker processes, until close is called.
+    Every iteration only the difference profile is sent to the workers, through shared memory.
+    Only the flexible devices are planned, see flexible.
+    """
+
+    def __init__(self, devices: list[AbstractDevice], intervals: int, processes: int, batched: bool = False):
+        self.intervals = intervals
+        self._shm = shared_memory.SharedMemory(create=True, size=max(1, intervals) * 8)
+        self._d = np.ndarray((intervals,), dtype=np.float64, buffer=self._shm.buf)
+        # The shared memory block is removed at exit when the pool is not closed
+        self._finalizer = weakref.finalize(self, self._shm.unlink)
+
+        # Split the devices in contiguous chunks, such that the order of the devices is preserved
+        processes = max(1, min(processes, len(devices)))
+        bounds = np.linspace(0, len(devices), processes + 1).astype(int)
+        self._owner = []  # (worker index, local index) for each device
+        self._starts = bounds[:-1].tolist()  # index of the first device of each worker
+        self._conns = []
+        self._processes = []
+
+        ctx = multiprocessing.get_context()
+        for w in range(processes):
+            chunk = devices[bounds[w]:bounds[w + 1]]
+            self._owner.extend((w, j) for j in range(len(chunk)))
+            parent, child = ctx.Pipe()
+            process = ctx.Process(target=_worker, args=(chunk, self._shm.name, intervals, batched, child),
+                                  daemon=True)
+            process.start()
+            child.close()
+            self._conns.append(parent)
+            self._processes.append(process)
+
+    @staticmethod
+    def _receive(conn) -> object:
+        """
+        Receives the result of a command from a worker, an exception raised in the worker is raised again
+        :param conn: pipe to the worker
+        :return: result of the command
+        """
+        result = conn.recv()
+        if isinstance(result, _Failure):
+            raise result.exception from RemoteTraceback(result.tb)
+        return result
+
+    def _broadcast(self, command: str, args: list) -> list:
+        """
+        Sends a command to every worker. Every worker answers before an exception is raised, such that no answer is
+        left behind in a pipe.
+        :param command: command
+        :param args: argument of the command for each worker
+        :return: results of the workers, in order
+        """
+        for conn, arg in zip(self._conns, args):
+            conn.send((command, arg))
+        results = [conn.recv() for conn in self._conns]
+        for result in results:
+            if isinstance(result, _Failure):
+                raise result.exception from RemoteTraceback(result.tb)
+        return results
+
+    def plan(self, d: list[float], latencies: dict[int, float] | None = None,
+             d_norm: float | None = None) -> list[float]:
+        """
+        Requests a new candidate profile from every flexible device, in parallel
+        :param d: Difference profile
+        :param latencies: If given, the plan time of each device is stored in it, keyed on its position in flexible
+        :param d_norm: ||d||, calculated when not given
+        :return: Improvements, in the same order as the flexible devices
+        """
+        self._d[:] = d
+        if d_norm is None:
+            d_norm = np.linalg.norm(self._d)
+
+        improvements = []
+        for worker_improvements, worker_latencies in self._broadcast("plan", [(latencies is not None, float(d_norm))] * len(self._conns)):
+            if latencies is not None:
+                latencies.update((len(improvements) + index, latency) for index, latency in worker_latencies.items())
+            improvements.extend(worker_improvements)
+        return improvements
+
+    def flexible(self) -> list[int]:
+        """
+        Determines which devices are flexible, only these are planned from here on
+        :return: indices of the flexible devices
+        """
+        flexible = []
+        for start, active in zip(self._starts, self._broadcast("flexible", [None] * len(self._conns))):
+            flexible.extend(start + j for j in active)
+        return flexible
+
+    def shift_private(self, steps: int, backend: PrivacyBackend) -> list:
+        """
+        Moves all devices forward in time, see AbstractDevice.shift_private
+        :param steps: number of intervals
+        :param backend: privacy backend of the aggregator
+        :return: private representations of the profiles over the new horizon, in the same order as the devices
+        """
+        # Every worker gets its own backend, see PrivacyBackend.spawn
+        results = self._broadcast("shift_private", [(steps, backend.spawn()) for _ in self._conns])
+        return [backend.deserialize(data) for result in results for data in result]
+
+    def set_interval_merge(self, intervalMerge) -> None:
+        """
+        Sets the resolution of the flexible devices, see AbstractDevice.set_interval_merge
+        :param intervalMerge: intervalMerge vector, None for full resolution
+        :return: None
+        """
+        self._broadcast("interval_merge", [intervalMerge] * len(self._conns))
+
+    def candidate_diff(self, index: int) -> list[float]:
+        """
+        Difference between the candidate profile and the profile of a device, without accepting it
+        :param index: index of the device
+        :return: Difference between the candidate profile and the profile of the device
+        """
+        w, j = self._owner[index]
+        self._conns[w].send(("diff", j))
+        return self._receive(self._conns[w])
+
+    def accept(self, index: int) -> list[float]:
+        """
+        Accepts the candidate profile of a device, on the worker that owns it
+        :param index: index of the device
+        :return: Difference between the new and the previous profile of the device
+        """
+        w, j = self._owner[index]
+        self._conns[w].send(("accept", j))
+        return self._receive(self._conns[w])
+
+    def accept_private(self, index: int, backend: PrivacyBackend) -> object:
+        """
+        Accepts the candidate profile of a device, on the worker that owns it
+        :param index: index of the device
+        :param backend: privacy backend of the aggregator
+        :return: Private representation of the difference between the new and the previous profile of the device
+        """
+        w, j = self._owner[index]
+        self._conns[w].send(("accept_private", (j, backend.spawn())))
+        return backend.deserialize(self._receive(self._conns[w]))
+
+    def close(self) -> list[AbstractDevice]:
+        """
+        Stops the workers. When some of them have died, the other workers are stopped as well and RuntimeError is
+        raised, since the state of the devices of the dead workers is lost.
+        :return: The devices, including the state they have in the workers
+        """
+        devices = []
+        lost = 0
+        try:
+            for conn in self._conns:
+                try:
+                    conn.send(("close", None))
+                    devices.extend(conn.recv())
+                except (EOFError, OSError):
+                    lost += 1
+        finally:
+            for process in self._processes:
+                process.join(timeout=1.0)
+                if process.is_alive():
+                    process.terminate()
+                    process.join()
+            for conn in self._conns:
+                conn.close()
+
+            del self._d
+            self._shm.close()
+            self._finalizer()
+
+        if lost:
+            raise RuntimeError("%d worker(s) died, the state of their devices is lost" % lost)
+        return devices
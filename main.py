@@ -29,6 +29,7 @@ from dev.electricvehicle import ElectricVehicle
 from dev.heatpump import HeatPump
 from dev.load import Load
 from profilesteering import ProfileSteering
+from telemetry import PrintObserver
 
 # Initialisation
 devices = []
@@ -60,7 +61,7 @@ for i in range(0, 20):
     devices.append(HeatPump())
 
 # Run the Profile Steering algorithm
-ps = ProfileSteering(devices)
+ps = ProfileSteering(devices, observers=[PrintObserver()])  # PrintObserver reports every iteration on stdout
 power_profile = ps.init(desired_profile)
 power_profile = ps.iterative(e_min, max_iters)
 
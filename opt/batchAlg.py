@@ -0,0 +1,181 @@
+# Copyright 2023 University of Twente
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Batched variant of the continuous buffer planning in optAlg.py
+# Solves the planning problems of many buffers (e.g. batteries, heat pumps) at once with NumPy.
+# The recursion of OptAlg.bufferPlanning, which splits the horizon at SoC violations, is kept as a queue of segments.
+# All pending segments of all devices are solved together in one round, such that the work per round consists of
+# array operations over (segments x intervals) matrices.
+#
+# Supported: continuous mode, no power limits, no prices (beta = 1), no reactive power and no interval merging.
+
+import numpy as np
+
+
+class BatchOptAlg:
+    def fillLevel(self, desired, valid, powerMin, powerMax, chargeRequired):
+        # Vectorized water filling, each row is a separate problem:
+        #    result[r, t] = min(max(desired[r, t] + level[r], powerMin[r]), powerMax[r])
+        # such that the sum over the valid intervals of each row equals chargeRequired[r]
+        rows, cols = desired.shape
+        width = (powerMax - powerMin)[:, None]
+        n = valid.sum(axis=1)
+        target = chargeRequired - powerMin * n
+
+        # Lower kinks of every row, sorted. Padding is pushed to the end
+        lower = np.sort(np.where(valid, powerMin[:, None] - desired, np.inf), axis=1)
+        kinks = np.concatenate((lower, lower + width), axis=1)
+        order = np.argsort(kinks, axis=1, kind='stable')
+        kinks = np.take_along_axis(kinks, order, axis=1)
+
+        # Number of lower and upper kinks passed at each kink
+        isLower = order < cols
+        passedLower = np.cumsum(isLower, axis=1)
+        passedUpper = np.cumsum(~isLower, axis=1)
+
+        with np.errstate(invalid='ignore'):
+            cumLower = np.concatenate((np.zeros((rows, 1)), np.cumsum(lower, axis=1)), axis=1)
+            filled = passedLower * kinks - np.take_along_axis(cumLower, passedLower, axis=1) \
+                - passedUpper * (kinks - width) + np.take_along_axis(cumLower, passedUpper, axis=1)
+        filled = np.where(np.isfinite(kinks), filled, np.inf)
+
+        # The level lies on the last segment of which the start does not exceed the target
+        position = np.maximum((filled <= target[:, None]).sum(axis=1) - 1, 0)
+        start = np.take_along_axis(kinks, position[:, None], axis=1)[:, 0]
+        slope = (np.take_along_axis(passedLower, position[:, None], axis=1)
+                 - np.take_along_axis(passedUpper, position[:, None], axis=1))[:, 0]
+        excess = target - np.take_along_axis(filled, position[:, None], axis=1)[:, 0]
+        level = start + np.where(slope > 0, excess / np.maximum(slope, 1), 0)
+
+        result = np.clip(desired + level[:, None] - powerMin[:, None], 0, width) + powerMin[:, None]
+
+        # Trivial cases: nothing to charge, or charging at maximum power is required
+        result = np.where((target <= 0)[:, None], powerMin[:, None], result)
+        result = np.where((target >= width[:, 0] * n)[:, None], powerMax[:, None], result)
+        return np.where(valid, result, 0)
+
+    # Batched equivalent of OptAlg.bufferPlanning in continuous mode
+    # Input:
+    #    desired:        matrix (devices x intervals) with the desired profiles
+    #    targetSoC, initialSoC, capacity, powerMin, powerMax:    per device values (scalars are broadcast)
+    #    demand:         matrix (devices x intervals) with the demand of the buffer, None for no demand
+    def bufferPlanning(self, desired, targetSoC, initialSoC, capacity, demand, powerMin, powerMax):
+        desired = np.asarray(desired, dtype=np.float64)
+        devices, intervals = desired.shape
+        if demand is None:
+            demand = np.zeros((devices, intervals))
+        demand = np.broadcast_to(np.asarray(demand, dtype=np.float64), desired.shape)
+
+        capacity = np.broadcast_to(np.asarray(capacity, dtype=np.float64), (devices,))
+        powerMax = np.broadcast_to(np.asarray(powerMax, dtype=np.float64), (devices,))
+        powerMin = np.broadcast_to(np.asarray(powerMin, dtype=np.float64), (devices,))
+        # A powerMin close to zero is treated as zero, like OptAlg.continuousBufferPlanning does
+        powerMin = np.where(np.abs(powerMin) > 0.0001, powerMin, 0.0)
+
+        assert (np.all(initialSoC <= capacity))
+        assert (np.all(targetSoC <= capacity))
+        assert (np.all(demand >= -0.0001))
+
+        result = np.zeros((devices, intervals))
+
+        # Queue of segments still to be planned: device, start, length, initial SoC, target SoC
+        dev = np.arange(devices)
+        start = np.zeros(devices, dtype=int)
+        length = np.full(devices, intervals, dtype=int)
+        initial = np.broadcast_to(np.asarray(initialSoC, dtype=np.float64), (devices,)).copy()
+        target = np.broadcast_to(np.asarray(targetSoC, dtype=np.float64), (devices,)).copy()
+
+        while len(dev) > 0:
+            offsets = np.arange(length.max())
+            valid = offsets[None, :] < length[:, None]
+            columns = np.minimum(start[:, None] + offsets[None, :], intervals - 1)
+            segDesired = np.where(valid, desired[dev[:, None], columns], 0)
+            segDemand = np.where(valid, demand[dev[:, None], columns], 0)
+            cap = capacity[dev]
+            pMax = powerMax[dev]
+
+            children = []
+
+            # First check the feasibility of the demand: the SoC when charging at maximum power must not become negative
+            increase = np.cumsum(np.where(valid, pMax[:, None] - segDemand, 0), axis=1)
+            maxSoC = increase + np.minimum(initial[:, None],
+                                           np.minimum.accumulate(cap[:, None] - increase, axis=1))
+            maxSoC = np.where(valid, maxSoC, np.inf)
+            violationMax = np.argmin(maxSoC, axis=1)
+            infeasible = (np.min(maxSoC, axis=1) < 0) & (violationMax > 0)
+
+            for r in np.flatnonzero(infeasible):
+                violationIndexMax = violationMax[r]
+                violationIndexMin = violationIndexMax
+                while violationIndexMin > 0 and segDemand[r, violationIndexMin - 1] > pMax[r] * pMax[r]:
+                    violationIndexMin -= 1
+
+                if violationIndexMin > 0:
+                    children.append((dev[r], start[r], violationIndexMin, initial[r], cap[r]))
+                result[dev[r], start[r] + violationIndexMin:start[r] + violationIndexMax + 1] = pMax[r]
+                if violationIndexMax < length[r] - 1:
+                    children.append((dev[r], start[r] + violationIndexMax + 1, length[r] - violationIndexMax - 1,
+                                     0.0, target[r]))
+
+            # Naive planning that ignores the SoC constraints
+            chargeRequired = target + segDemand.sum(axis=1) - initial
+            naivePlan = self.fillLevel(segDesired, valid, powerMin[dev], pMax, chargeRequired)
+
+            # Determine the largest SoC violation of the naive planning, the last interval is not checked
+            soc = initial[:, None] + np.cumsum(naivePlan - segDemand, axis=1)
+            violation = np.maximum(soc - cap[:, None], -soc)
+            violation = np.where(offsets[None, :] < (length - 1)[:, None], violation, -np.inf)
+            violationIndex = np.argmax(violation, axis=1)
+            socAtIndex = soc[np.arange(len(dev)), violationIndex]
+            violationAtIndex = violation[np.arange(len(dev)), violationIndex]
+            upperBound = socAtIndex - cap >= -socAtIndex
+            split = (violationAtIndex > 0.01) & ~infeasible
+
+            for r in np.flatnonzero(split):
+                v = violationIndex[r]
+                if upperBound[r]:
+                    children.append((dev[r], start[r], v + 1, initial[r], cap[r]))
+                    children.append((dev[r], start[r] + v + 1, length[r] - v - 1, cap[r], target[r]))
+                else:
+                    children.append((dev[r], start[r], v + 1, initial[r], 0.0))
+                    children.append((dev[r], start[r] + v + 1, length[r] - v - 1, 0.0, target[r]))
+
+            # The naive planning is the answer for all other segments
+            done = ~infeasible & ~split
+            r, c = np.nonzero(valid & done[:, None])
+            result[dev[r], start[r] + c] = naivePlan[r, c]
+
+            if children:
+                dev, start, length, initial, target = (np.array(column) for column in zip(*children))
+                start = start.astype(int)
+                length = length.astype(int)
+                initial = initial.astype(np.float64)
+                target = target.astype(np.float64)
+            else:
+                dev = np.array([], dtype=int)
+
+        return result
+
+    # Improvement of each candidate over the current profile, as calculated by AbstractDevice.improvement:
+    #    ||d|| - ||candidate - profile + d||, as a difference of squares divided by the sum of the norms
+    def improvements(self, profiles, candidates, d, d_norm=None):
+        d = np.asarray(d, dtype=np.float64)
+        if d_norm is None:
+            d_norm = np.linalg.norm(d)
+        change = candidates - profiles
+        difference = -np.einsum('ij,ij->i', change, change) - 2 * (change @ d)  # ||d||^2 - ||change + d||^2
+        candidateNorm = np.sqrt(np.maximum(d_norm * d_norm - difference, 0.0))
+        total = d_norm + candidateNorm
+        return np.divide(difference, total, out=np.zeros(len(difference)), where=total > 0)
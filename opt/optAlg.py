@@ -30,16 +30,48 @@
 import math
 import sys
 
+import numpy as np
+
+
+# State that a single device keeps between its plans, used to warm start continuousBufferPlanningPositiveNumpy.
+# OptAlg itself is shared by all devices, hence the device passes its own state to bufferPlanning.
+class WarmStart:
+    def __init__(self):
+        # Sort orders and fill level of the previous plan, per length of the (sub)problem since bufferPlanning may
+        # split the horizon
+        self.states = {}
+
+    # Moves the state of a problem forward in time, e.g. for a receding horizon. The first intervals are dropped,
+    # the new intervals at the end are appended to the sort orders. States of subproblems are dropped.
+    def shift(self, steps, length, newLength):
+        state = self.states.get(length)
+        self.states = {}
+        if state is not None:
+            lowerOrder, upperOrder, level = state
+            lowerOrder = lowerOrder[(lowerOrder >= steps) & (lowerOrder < newLength + steps)] - steps
+            upperOrder = upperOrder[(upperOrder >= steps) & (upperOrder < newLength + steps)] - steps
+            tail = np.arange(max(length - steps, 0), newLength)
+            self.states[newLength] = (np.concatenate((lowerOrder, tail)), np.concatenate((upperOrder, tail)), level)
+
 
 class OptAlg:
+    # Shorter problems are planned faster without warm start, the overhead of the search dominates
+    warmStartLength = 512
+
     def __init__(self):
         self.fillLevel = 0
 
     def continuousBufferPlanning(self, desired, chargeRequired, powerMin, powerMax, powerLimitsLower=[],
-                                 powerLimitsUpper=[], prices=None, beta=1):
+                                 powerLimitsUpper=[], prices=None, beta=1, intervalMerge=None, warmStart=None):
         if prices is None:
             prices = [0] * len(desired)
 
+        # Merged intervals are planned by the weighted kernel, which does not expand them to the full horizon
+        if intervalMerge is not None and any(merge != 1 for merge in intervalMerge):
+            assert (len(intervalMerge) == len(desired))
+            return self.continuousBufferPlanningMerged(desired, chargeRequired, powerMin, powerMax, intervalMerge,
+                                                       powerLimitsLower, powerLimitsUpper, prices=prices, beta=beta)
+
         # Gerwin: Added also option to have positive lower limits:
         positiveLowerBound = False
         for lim in powerLimitsLower:
@@ -53,15 +85,19 @@ class OptAlg:
             if len(powerLimitsLower) != len(desired) or len(powerLimitsUpper) != len(desired):
                 # scale first
                 chargeRequiredNew = chargeRequired - powerMin * len(desired)
-                desiredNew = []
                 powerMaxNew = powerMax - powerMin
-                for i in range(0, len(desired)):
-                    desiredNew.append(desired[i] - powerMin)
+                if isinstance(desired, np.ndarray):
+                    desiredNew = desired - powerMin  # Keep NumPy input for the vectorized kernel
+                else:
+                    desiredNew = []
+                    for i in range(0, len(desired)):
+                        desiredNew.append(desired[i] - powerMin)
 
                 # And now call the positive only function (the original EV algorithm):
                 result = self.continuousBufferPlanningPositive(desiredNew, chargeRequiredNew, powerMaxNew,
                                                                prices=prices,
-                                                               beta=beta)  # We can omit power limits here as they do not exist apparently
+                                                               beta=beta,
+                                                               warmStart=warmStart)  # We can omit power limits here as they do not exist apparently
 
                 assert (len(result) == len(desired))
                 # scale back the answer
@@ -191,7 +227,8 @@ class OptAlg:
                     powerLimitsUpperNew.append(upperLimits[i] - lowerLimits[i])
 
                 result = self.continuousBufferPlanningPositive(desiredNew, chargeRequiredNew, powerMaxNew,
-                                                               powerLimitsUpperNew, prices=prices, beta=beta)
+                                                               powerLimitsUpperNew, prices=prices, beta=beta,
+                                                               warmStart=warmStart)
 
                 assert (len(result) == len(desired))
 
@@ -204,12 +241,96 @@ class OptAlg:
         # If PowerMin == 0 we can use the positive only variant (all boils down to that algorithm in the end)
         else:
             result = self.continuousBufferPlanningPositive(desired, chargeRequired, powerMax, powerLimitsUpper,
-                                                           prices=prices, beta=beta)
+                                                           prices=prices, beta=beta, warmStart=warmStart)
             assert (len(result) == len(desired))
             return result
 
+    # Continuous planning of merged intervals, O(m log m) for m merged intervals.
+    # A merged interval of length w weighs both the deviation and the charged energy with w. The optimal plan is
+    # therefore the plan of the problem in which every merged interval is repeated w times, i.e. the same fill level
+    # structure, but the charged amount as function of the fill level has slopes that are sums of weights:
+    #   charged(level) = sum_i w_i * clip(level - lowerLevels_i, 0, upper_i - lower_i)
+    # Power limits that are too stringent and pure price steering are rare, these expand the merged intervals.
+    def continuousBufferPlanningMerged(self, desired, chargeRequired, powerMin, powerMax, intervalMerge,
+                                       powerLimitsLower=[], powerLimitsUpper=[], prices=None, beta=1):
+        desired = np.asarray(desired, dtype=np.float64)
+        weights = np.asarray(intervalMerge, dtype=np.float64)
+        n = len(desired)
+
+        lower = np.full(n, float(powerMin))
+        upper = np.full(n, float(powerMax))
+        if len(powerLimitsLower) == n:
+            lower = np.maximum(lower, np.asarray(powerLimitsLower, dtype=np.float64))
+        if len(powerLimitsUpper) == n:
+            upper = np.minimum(upper, np.asarray(powerLimitsUpper, dtype=np.float64))
+        totalLower = float(np.dot(weights, lower))
+        totalUpper = float(np.dot(weights, upper))
+
+        if chargeRequired <= powerMin * weights.sum():
+            return [powerMin] * n
+        if chargeRequired >= powerMax * weights.sum():
+            return [powerMax] * n
+
+        if beta == 0 or np.any(lower > upper) or not totalLower <= chargeRequired <= totalUpper:
+            merge = np.asarray(intervalMerge, dtype=int)
+            first = np.concatenate(([0], np.cumsum(merge)[:-1]))
+
+            def expand(values):
+                if len(values) != n:
+                    return values  # e.g. no power limits
+                return np.repeat(np.asarray(values, dtype=np.float64), merge)
+
+            result = self.continuousBufferPlanning(expand(desired), chargeRequired, powerMin, powerMax,
+                                                   list(expand(powerLimitsLower)), list(expand(powerLimitsUpper)),
+                                                   prices=None if prices is None else list(expand(prices)),
+                                                   beta=beta)
+            return np.asarray(result)[first].tolist()
+
+        if prices is None or beta == 1:
+            levels = -desired
+        else:
+            assert (len(prices) == n)
+            assert (beta > 0)
+            levels = np.asarray(prices, dtype=np.float64) / (2 * beta) - desired
+        lowerLevels = levels + lower
+        upperLevels = levels + upper
+        chargeRequired -= totalLower
+
+        lowerOrder = np.argsort(lowerLevels)
+        upperOrder = np.argsort(upperLevels)
+        sortedLowerLevels = lowerLevels[lowerOrder]
+        sortedUpperLevels = upperLevels[upperOrder]
+        # Weighted cumulative sums, the slope of the charged amount changes by the weight at each kink
+        weightLower = np.concatenate(([0.0], np.cumsum(weights[lowerOrder])))
+        weightUpper = np.concatenate(([0.0], np.cumsum(weights[upperOrder])))
+        cumLower = np.concatenate(([0.0], np.cumsum(weights[lowerOrder] * sortedLowerLevels)))
+        cumUpper = np.concatenate(([0.0], np.cumsum(weights[upperOrder] * sortedUpperLevels)))
+
+        # Charged amount at each kink
+        kinks = np.sort(np.concatenate((sortedLowerLevels, sortedUpperLevels)))
+        passedLower = np.searchsorted(sortedLowerLevels, kinks, side='right')
+        passedUpper = np.searchsorted(sortedUpperLevels, kinks, side='right')
+        slopes = weightLower[passedLower] - weightUpper[passedUpper]
+        charged = slopes * kinks - cumLower[passedLower] + cumUpper[passedUpper]
+
+        position = max(int(np.searchsorted(charged, chargeRequired, side='right')) - 1, 0)
+        breakpoint = kinks[position]
+        if slopes[position] > 0:
+            breakpoint += (chargeRequired - charged[position]) / slopes[position]
+
+        result = np.where(breakpoint >= upperLevels, upper,
+                          np.where(breakpoint > lowerLevels, breakpoint - levels, lower))
+
+        self.fillLevel = float(breakpoint)
+        return result.tolist()
+
     def continuousBufferPlanningPositive(self, desired, chargeRequired, powerMax, powerLimitsUpper=[], prices=None,
-                                         beta=1):
+                                         beta=1, warmStart=None):
+        # NumPy input is planned by the vectorized kernel
+        if isinstance(desired, np.ndarray):
+            return self.continuousBufferPlanningPositiveNumpy(desired, chargeRequired, powerMax, powerLimitsUpper,
+                                                              prices=prices, beta=beta, warmStart=warmStart)
+
         if prices is None:
             prices = [0] * len(desired)
 
@@ -342,6 +463,142 @@ class OptAlg:
         assert (len(result) == len(desired))
         return result
 
+    # Vectorized variant of continuousBufferPlanningPositive, O(n log n) instead of a step by step breakpoint search
+    # The charged amount as function of the fill level is piecewise linear with kinks at the lower and upper levels.
+    # It is evaluated at all kinks at once with cumulative sums and searchsorted, after which the fill level is
+    # interpolated on the segment that contains chargeRequired.
+    def continuousBufferPlanningPositiveNumpy(self, desired, chargeRequired, powerMax, powerLimitsUpper=[],
+                                              prices=None, beta=1, warmStart=None):
+        desired = np.asarray(desired, dtype=np.float64)
+        n = len(desired)
+
+        # Check whether we need to charge anyways (trivial..)
+        if chargeRequired <= 0:
+            return [0] * n
+
+        powerLimits = np.full(n, powerMax, dtype=np.float64)
+        if len(powerLimitsUpper) == n:
+            powerLimits = np.minimum(np.asarray(powerLimitsUpper, dtype=np.float64), powerMax)
+            assert np.all(powerLimits >= -0.0001)  # very small negative floats may occur, ignore these.
+            powerLimits = np.maximum(powerLimits, 0)
+
+        if chargeRequired > powerMax * n:
+            return [powerMax] * n
+
+        # Power limits that are too stringent and pure price steering are handled by the original code
+        if (len(powerLimitsUpper) == n and powerLimits.sum() < chargeRequired) or beta == 0:
+            return self.continuousBufferPlanningPositive(desired.tolist(), chargeRequired, powerMax,
+                                                         list(powerLimitsUpper), prices=prices, beta=beta)
+
+        if prices is None or beta == 1:
+            lowerLevels = -desired
+        else:
+            assert (len(prices) == n)
+            assert (beta > 0)
+            lowerLevels = np.asarray(prices, dtype=np.float64) / (2 * beta) - desired
+        upperLevels = lowerLevels + powerLimits
+
+        if warmStart is not None and n >= self.warmStartLength:
+            return self.warmBufferPlanningPositive(lowerLevels, upperLevels, powerLimits, chargeRequired, warmStart)
+
+        sortedLowerLevels = np.sort(lowerLevels)
+        sortedUpperLevels = np.sort(upperLevels)
+        cumLower = np.concatenate(([0.0], np.cumsum(sortedLowerLevels)))
+        cumUpper = np.concatenate(([0.0], np.cumsum(sortedUpperLevels)))
+
+        # Charged amount at each kink
+        kinks = np.sort(np.concatenate((sortedLowerLevels, sortedUpperLevels)))
+        passedLower = np.searchsorted(sortedLowerLevels, kinks, side='right')
+        passedUpper = np.searchsorted(sortedUpperLevels, kinks, side='right')
+        charged = (passedLower - passedUpper) * kinks - cumLower[passedLower] + cumUpper[passedUpper]
+
+        position = max(int(np.searchsorted(charged, chargeRequired, side='right')) - 1, 0)
+        breakpoint = kinks[position]
+        slope = passedLower[position] - passedUpper[position]
+        if slope > 0:
+            breakpoint += (chargeRequired - charged[position]) / slope
+
+        result = np.where(breakpoint >= upperLevels, powerLimits,
+                          np.where(breakpoint > lowerLevels, breakpoint - lowerLevels, 0.0))
+
+        self.fillLevel = float(breakpoint)
+        return result.tolist()
+
+    # Warm started variant of the fill level search of continuousBufferPlanningPositiveNumpy, gives the same result.
+    # Between two plans of the same device the levels only change where the other devices moved, so:
+    # - the sort order of the previous plan is repaired with a stable sort (timsort), close to O(n) on nearly sorted
+    #   input instead of O(n log n)
+    # - the fill level is searched from the previous fill level outwards (galloping), instead of evaluating all kinks
+    def warmBufferPlanningPositive(self, lowerLevels, upperLevels, powerLimits, chargeRequired, warmStart):
+        n = len(lowerLevels)
+        state = warmStart.states.get(n)
+        if state is None:
+            lowerOrder = np.argsort(lowerLevels, kind='stable')
+            upperOrder = np.argsort(upperLevels, kind='stable')
+            previousLevel = None
+        else:
+            lowerOrder, upperOrder, previousLevel = state
+            lowerOrder = lowerOrder[np.argsort(lowerLevels[lowerOrder], kind='stable')]
+            upperOrder = upperOrder[np.argsort(upperLevels[upperOrder], kind='stable')]
+
+        sortedLowerLevels = lowerLevels[lowerOrder]
+        sortedUpperLevels = upperLevels[upperOrder]
+        cumLower = np.concatenate(([0.0], np.cumsum(sortedLowerLevels)))
+        cumUpper = np.concatenate(([0.0], np.cumsum(sortedUpperLevels)))
+
+        # Charged amount at a single fill level, nondecreasing in the level
+        def charged(level):
+            passedLower = int(np.searchsorted(sortedLowerLevels, level, side='right'))
+            passedUpper = int(np.searchsorted(sortedUpperLevels, level, side='right'))
+            return (passedLower - passedUpper) * level - cumLower[passedLower] + cumUpper[passedUpper], \
+                passedLower - passedUpper
+
+        # Last kink of a sorted array at which at most chargeRequired is charged, -1 if there is none
+        def lastKink(kinks):
+            if previousLevel is None:
+                position = 0
+            else:
+                position = min(int(np.searchsorted(kinks, previousLevel)), n - 1)
+
+            step = 1
+            if charged(kinks[position])[0] <= chargeRequired:
+                lower = position
+                while lower + step < n and charged(kinks[lower + step])[0] <= chargeRequired:
+                    lower += step
+                    step *= 2
+                upper = min(lower + step, n)
+            else:
+                upper = position
+                while upper - step >= 0 and charged(kinks[upper - step])[0] > chargeRequired:
+                    upper -= step
+                    step *= 2
+                lower = max(upper - step, -1)
+
+            # Bisect, the kink at lower charges at most chargeRequired, the kink at upper charges more
+            while upper - lower > 1:
+                middle = (lower + upper) // 2
+                if charged(kinks[middle])[0] <= chargeRequired:
+                    lower = middle
+                else:
+                    upper = middle
+            return lower
+
+        breakpoint = sortedLowerLevels[max(lastKink(sortedLowerLevels), 0)]
+        position = lastKink(sortedUpperLevels)
+        if position >= 0:
+            breakpoint = max(breakpoint, sortedUpperLevels[position])
+        chargedAtBreakpoint, slope = charged(breakpoint)
+        if slope > 0:
+            breakpoint += (chargeRequired - chargedAtBreakpoint) / slope
+
+        warmStart.states[n] = (lowerOrder, upperOrder, breakpoint)
+
+        result = np.where(breakpoint >= upperLevels, powerLimits,
+                          np.where(breakpoint > lowerLevels, breakpoint - lowerLevels, 0.0))
+
+        self.fillLevel = float(breakpoint)
+        return result.tolist()
+
     def continuousBufferPlanningPrices(self, chargeRequired, powerMax, powerLimitsUpper, prices):
         assert (prices != None)
         result = [0] * len(prices)
@@ -643,7 +900,7 @@ class OptAlg:
     # The main bufferplanning function that does all the magic!
     def bufferPlanning(self, desired, targetSoC, initialSoC, capacity, demand, chargingPowers, powerMin=0, powerMax=0,
                        powerLimitsLower=[], powerLimitsUpper=[], reactivePower=False, prices=None, beta=1,
-                       efficiency=None, intervalMerge=None):
+                       efficiency=None, intervalMerge=None, warmStart=None):
         if prices is None:
             prices = [0] * len(desired)
 
@@ -732,7 +989,8 @@ class OptAlg:
             if len(powerLimitsUpper) == len(desired):
                 if continuousMode:
                     # We determine the maxSoC based on the maximum charging power and the limits
-                    maxSoC += max(powerLimitsUpper[i], chargingPowers[-1] * efficiency[-1]) - demand[i]
+                    maxSoC += (max(powerLimitsUpper[i], chargingPowers[-1] * efficiency[-1]) - demand[i]) * \
+                              intervalMerge[i]
                 else:
                     if powerLimitsUpper[i] < chargingPowers[-1]:
                         # Limits are restrictive, get the maximum charging power that fits:
@@ -747,7 +1005,7 @@ class OptAlg:
                         # No restriction, just use the maximum charging power
                         maxSoC += chargingPowers[-1] * efficiency[-1] * intervalMerge[i] - demand[i] * intervalMerge[i]
             else:
-                maxSoC += chargingPowers[-1] * efficiency[-1] - demand[i] * intervalMerge[i]
+                maxSoC += (chargingPowers[-1] * efficiency[-1] - demand[i]) * intervalMerge[i]
 
             maxSoC = min(maxSoC, capacity[i])
 
@@ -775,7 +1033,8 @@ class OptAlg:
                                                        demand[0:violationIndexMin], [], powerMin, powerMax,
                                                        powerLimitsLower[0:violationIndexMin],
                                                        powerLimitsUpper[0:violationIndexMin],
-                                                       prices=prices[0:violationIndexMin], beta=beta)
+                                                       prices=prices[0:violationIndexMin], beta=beta,
+                                                       intervalMerge=intervalMerge[0:violationIndexMin], warmStart=warmStart)
                 else:
                     planMaxFirst = self.bufferPlanning(desired[0:violationIndexMin], capacity[violationIndexMin],
                                                        initialSoC, capacity[0:violationIndexMin],
@@ -794,7 +1053,8 @@ class OptAlg:
                                                       capacity[violationIndexMax + 1:], demand[violationIndexMax + 1:],
                                                       [], powerMin, powerMax, powerLimitsLower[violationIndexMax + 1:],
                                                       powerLimitsUpper[violationIndexMax + 1:],
-                                                      prices=prices[violationIndexMax + 1:], beta=beta)
+                                                      prices=prices[violationIndexMax + 1:], beta=beta,
+                                                      intervalMerge=intervalMerge[violationIndexMax + 1:], warmStart=warmStart)
                 else:
                     planMaxLast = self.bufferPlanning(desired[violationIndexMax + 1:], targetSoC, 0.0,
                                                       capacity[violationIndexMax + 1:], demand[violationIndexMax + 1:],
@@ -821,7 +1081,8 @@ class OptAlg:
         # //Then we determine if this naiveplanning works, and if not, where it makes the largest error in SoC
         if continuousMode:
             naivePlan = self.continuousBufferPlanning(desired, targetSoC + demandTotal - initialSoC, powerMin, powerMax,
-                                                      powerLimitsLower, powerLimitsUpper, prices=prices, beta=beta)
+                                                      powerLimitsLower, powerLimitsUpper, prices=prices, beta=beta,
+                                                      intervalMerge=intervalMerge, warmStart=warmStart)
         else:
             naivePlan = self.discreteBufferPlanning(desired, targetSoC + demandTotal - initialSoC, chargingPowers,
                                                     powerLimitsLower, powerLimitsUpper, prices=prices, beta=beta,
@@ -854,13 +1115,15 @@ class OptAlg:
                                                         demand[0:violationIndex + 1], [], powerMin, powerMax,
                                                         powerLimitsLower[0:violationIndex + 1],
                                                         powerLimitsUpper[0:violationIndex + 1],
-                                                        prices=prices[0:violationIndex + 1], beta=beta)
+                                                        prices=prices[0:violationIndex + 1], beta=beta,
+                                                        intervalMerge=intervalMerge[0:violationIndex + 1], warmStart=warmStart)
                         planLast = self.bufferPlanning(desired[violationIndex + 1:], targetSoC,
                                                        capacity[violationIndex], capacity[violationIndex + 1:],
                                                        demand[violationIndex + 1:], [], powerMin, powerMax,
                                                        powerLimitsLower[violationIndex + 1:],
                                                        powerLimitsUpper[violationIndex + 1:],
-                                                       prices=prices[violationIndex + 1:], beta=beta)
+                                                       prices=prices[violationIndex + 1:], beta=beta,
+                                                       intervalMerge=intervalMerge[violationIndex + 1:], warmStart=warmStart)
                     else:
                         planFirst = self.bufferPlanning(desired[0:violationIndex + 1], capacity[violationIndex + 1],
                                                         initialSoC, capacity[0:violationIndex + 1],
@@ -884,12 +1147,14 @@ class OptAlg:
                                                         capacity[0:violationIndex + 1], demand[0:violationIndex + 1],
                                                         [], powerMin, powerMax, powerLimitsLower[0:violationIndex + 1],
                                                         powerLimitsUpper[0:violationIndex + 1],
-                                                        prices=prices[0:violationIndex + 1], beta=beta)
+                                                        prices=prices[0:violationIndex + 1], beta=beta,
+                                                        intervalMerge=intervalMerge[0:violationIndex + 1], warmStart=warmStart)
                         planLast = self.bufferPlanning(desired[violationIndex + 1:], targetSoC, 0.0,
                                                        capacity[violationIndex + 1:], demand[violationIndex + 1:], [],
                                                        powerMin, powerMax, powerLimitsLower[violationIndex + 1:],
                                                        powerLimitsUpper[violationIndex + 1:],
-                                                       prices=prices[violationIndex + 1:], beta=beta)
+                                                       prices=prices[violationIndex + 1:], beta=beta,
+                                                       intervalMerge=intervalMerge[violationIndex + 1:], warmStart=warmStart)
                     else:
                         planFirst = self.bufferPlanning(desired[0:violationIndex + 1], 0.0, initialSoC,
                                                         capacity[0:violationIndex + 1], demand[0:violationIndex + 1],
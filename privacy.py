@@ -0,0 +1,285 @@
+# Copyright 2023 University of Twente
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from abc import ABC, abstractmethod
+
+import numpy as np
+from Pyfhel import PyCtxt
+
+from crypto import PRIVACY_SCHEME, PrivacySchemes, DifferentialOptions, context, encrypt_packed, fold_packed, \
+    sum_ciphertexts
+from telemetry import PrivacyDiagnostics
+
+
+class PrivacyBackend(ABC):
+    """
+    How the profiles of the devices are hidden from the aggregator.
+    Devices encode their profiles and updates, the aggregator aggregates and updates them, and decodes the aggregate.
+    """
+
+    @abstractmethod
+    def encode(self, profile: np.ndarray):
+        """
+        Private representation of a profile, on the device side
+        :param profile: profile of a device
+        :return: private representation
+        """
+        pass
+
+    def encode_update(self, diff: np.ndarray):
+        """
+        Private representation of the change of a profile, on the device side
+        :param diff: difference between the new and the previous profile of a device
+        :return: private representation, that can be passed to update
+        """
+        return self.encode(diff)
+
+    def encode_fleet(self, devices: list, p: list[float]) -> list:
+        """
+        Creates the initial planning of all devices and their private representations, see AbstractDevice.init_private
+        :param devices: devices
+        :param p: desired profile
+        :return: private representations that are passed to aggregate, by default one per device in the same order
+        """
+        return [device.init_private(p, self) for device in devices]
+
+    @abstractmethod
+    def aggregate(self, representations: list, processes: int | None = None):
+        """
+        Sum of the private representations of all devices
+        :param representations: private representations
+        :param processes: number of worker processes the backend may use
+        :return: aggregate
+        """
+        pass
+
+    @abstractmethod
+    def update(self, aggregate, representation):
+        """
+        Incremental update of the aggregate with the change of a single device
+        :param aggregate: aggregate, may be modified
+        :param representation: private representation of the change, see encode_update
+        :return: updated aggregate
+        """
+        pass
+
+    @abstractmethod
+    def decode(self, aggregate, intervals: int) -> np.ndarray:
+        """
+        Plain sum of the profiles
+        :param aggregate: aggregate
+        :param intervals: number of intervals of the profiles
+        :return: sum of the profiles
+        """
+        pass
+
+    def spawn(self) -> "PrivacyBackend":
+        """
+        Backend that is sent to another process, e.g. to encode an update on a worker
+        :return: backend, with random streams that are independent of this one
+        """
+        return self
+
+    def serialize(self, representation):
+        """
+        Representation that can be sent to another process, see deserialize
+        :param representation: private representation
+        :return: picklable representation
+        """
+        return representation
+
+    def deserialize(self, data):
+        """
+        Inverse of serialize
+        :param data: picklable representation
+        :return: private representation
+        """
+        return data
+
+
+class PlaintextBackend(PrivacyBackend):
+    """
+    No privacy, profiles are passed on as they are, without copies or checks
+    """
+
+    def encode(self, profile: np.ndarray) -> np.ndarray:
+        return profile
+
+    def aggregate(self, representations: list[np.ndarray], processes: int | None = None) -> np.ndarray:
+        total = np.array(representations[0], dtype=np.float64)
+        for representation in representations[1:]:
+            total += representation
+        return total
+
+    def update(self, aggregate: np.ndarray, representation: np.ndarray) -> np.ndarray:
+        aggregate += representation
+        return aggregate
+
+    def decode(self, aggregate: np.ndarray, intervals: int) -> np.ndarray:
+        return aggregate
+
+
+class HomomorphicBackend(PrivacyBackend):
+    """
+    CKKS encryption, the aggregator only decrypts the sum
+    """
+
+    def __init__(self, packed: bool = False):
+        """
+        :param packed: at init, the devices send their profiles to a gateway, which packs the profiles of many devices
+        in the slots of a single ciphertext, see encode_group. The aggregator only receives ciphertexts.
+        """
+        self.packed = packed
+
+    def encode(self, profile: np.ndarray) -> PyCtxt:
+        return context().encryptFrac(np.asarray(profile, dtype=np.float64))
+
+    def encode_group(self, profiles: list[np.ndarray]) -> PyCtxt:
+        """
+        Encrypts the profiles of the devices behind a gateway packed in a single ciphertext, and sums them with
+        rotations, on the gateway side. The first len(profile) slots of the result hold the sum of the profiles,
+        like the ciphertext of a single device.
+        :param profiles: profiles of equal length, that fit in the slots of a ciphertext together
+        :return: ciphertext
+        """
+        ciphertexts = encrypt_packed(profiles)
+        if len(ciphertexts) != 1:
+            raise ValueError("%d profiles of %d intervals do not fit in a single ciphertext"
+                             % (len(profiles), len(profiles[0])))
+        return fold_packed(ciphertexts[0], len(profiles), len(profiles[0]))
+
+    def encode_fleet(self, devices: list, p: list[float]) -> list[PyCtxt]:
+        if not self.packed:
+            return super().encode_fleet(devices, p)
+
+        # Every gateway serves as many devices as fit in the slots of a ciphertext
+        blocks = context().get_nSlots() // len(p)
+        if blocks < 1:
+            raise ValueError("A profile of %d intervals does not fit in %d slots" % (len(p), context().get_nSlots()))
+        return [self.encode_group([np.asarray(device.init(p), dtype=np.float64)
+                                   for device in devices[start:start + blocks]])
+                for start in range(0, len(devices), blocks)]
+
+    def encode_update(self, diff: np.ndarray) -> PyCtxt:
+        # Updates are not packed, they only have to be correct in the first slots
+        return context().encryptFrac(np.asarray(diff, dtype=np.float64))
+
+    def aggregate(self, representations: list, processes: int | None = None) -> PyCtxt:
+        if not isinstance(representations[0], PyCtxt):
+            raise TypeError("Profiles must be a list of Pyfhel.PyCtxt when using homomorphic encryption")
+        return sum_ciphertexts(representations, processes)
+
+    def update(self, aggregate: PyCtxt, representation: PyCtxt) -> PyCtxt:
+        aggregate += representation
+        return aggregate
+
+    def decode(self, aggregate: PyCtxt, intervals: int) -> np.ndarray:
+        # we have to trim the decrypted sum to the number of intervals because CKKS pads it to 2**13
+        return np.asarray(context().decrypt(aggregate)[:intervals], dtype=np.float64)
+
+    def serialize(self, representation: PyCtxt) -> bytes:
+        return representation.to_bytes()
+
+    def deserialize(self, data: bytes) -> PyCtxt:
+        return PyCtxt(pyfhel=context(), bytestring=data)
+
+
+class DifferentialBackend(PrivacyBackend):
+    """
+    Differential privacy, devices add Laplace noise to their profiles
+    """
+
+    def __init__(self, scale: float = 200, diagnostics: PrivacyDiagnostics | None = None, seed: int | None = None,
+                 seed_sequence: np.random.SeedSequence | None = None):
+        """
+        :param scale: scale of the Laplace noise
+        :param diagnostics: receives the real and the noisy aggregate, see telemetry.py.
+        Without diagnostics the real profiles are not kept.
+        :param seed: seed of the noise, None uses the global np.random state
+        :param seed_sequence: seed of the noise, instead of seed
+        """
+        self.scale = scale
+        self.diagnostics = diagnostics
+        self.seed_sequence = seed_sequence if seed_sequence is not None or seed is None \
+            else np.random.SeedSequence(seed)
+        # Seed of the noise of encode and encode_update, and of the backends that are spawned
+        self._update_sequence = self._child(1) if self.seed_sequence is not None else None
+        self._random = None
+
+    def _child(self, *key: int) -> np.random.SeedSequence:
+        # Child of the seed with a fixed spawn key, the same on every call unlike SeedSequence.spawn.
+        # Child (0,) seeds the initial noise of the fleet, child (1,) the noise of encode and encode_update.
+        return np.random.SeedSequence(self.seed_sequence.entropy, spawn_key=self.seed_sequence.spawn_key + key,
+                                      pool_size=self.seed_sequence.pool_size)
+
+    def _generator(self) -> np.random.Generator:
+        if self.seed_sequence is None:
+            return np.random  # seeded with np.random.seed, like before
+        if self._random is None:
+            self._random = np.random.default_rng(self._update_sequence)
+        return self._random
+
+    def encode(self, profile: np.ndarray) -> tuple[np.ndarray, np.ndarray | None]:
+        # The real profile is only used to show the effect of the noise
+        profile = np.asarray(profile, dtype=np.float64)
+        noisy = profile + self._generator().laplace(0, self.scale, len(profile))
+        return noisy, profile.copy() if self.diagnostics is not None else None
+
+    def encode_fleet(self, devices: list, p: list[float]) -> list[tuple[np.ndarray, np.ndarray | None]]:
+        profiles = np.array([device.init(p) for device in devices], dtype=np.float64).reshape(len(devices), len(p))
+        # All noise is drawn at once. With a seed, the stream starts from the seed again on every call, so row i of the
+        # noise only depends on the seed, i and the number of intervals.
+        generator = np.random if self.seed_sequence is None else np.random.default_rng(self._child(0))
+        noise = generator.laplace(0, self.scale, profiles.shape)
+        noisy = profiles + noise
+        if self.diagnostics is None:
+            return [(row, None) for row in noisy]
+        return list(zip(noisy, profiles))
+
+    def spawn(self) -> "DifferentialBackend":
+        # Without a seed the worker gets fresh entropy, instead of the global state it shares with the other workers
+        child = self._update_sequence.spawn(1)[0] if self.seed_sequence is not None else np.random.SeedSequence()
+        return DifferentialBackend(self.scale, seed_sequence=child)
+
+    def aggregate(self, representations: list[tuple[np.ndarray, np.ndarray | None]],
+                  processes: int | None = None) -> np.ndarray:
+        if not isinstance(representations[0], tuple) or not isinstance(representations[0][0], np.ndarray):
+            raise TypeError("Profiles must be a list of (noisy, real) tuples when using differential privacy")
+        # Reductions over (devices x intervals) arrays
+        noisy_sum = np.stack([representation[0] for representation in representations]).sum(axis=0)
+
+        if self.diagnostics is not None:
+            real_sum = np.stack([representation[1] for representation in representations]).sum(axis=0)
+            self.diagnostics.on_aggregate(real_sum, noisy_sum)
+
+        return noisy_sum
+
+    def update(self, aggregate: np.ndarray, representation: tuple[np.ndarray, np.ndarray]) -> np.ndarray:
+        aggregate += representation[0]
+        return aggregate
+
+    def decode(self, aggregate: np.ndarray, intervals: int) -> np.ndarray:
+        return aggregate
+
+
+def default_backend() -> PrivacyBackend:
+    """
+    Backend of the privacy scheme that is selected with the PS_PRIVACY_SCHEME environment variable
+    :return: privacy backend
+    """
+    if PRIVACY_SCHEME == PrivacySchemes.HOMOMORPHIC:
+        return HomomorphicBackend()
+    elif PRIVACY_SCHEME == PrivacySchemes.DIFFERENTIAL:
+        return DifferentialBackend(DifferentialOptions["scale"])
+    return PlaintextBackend()
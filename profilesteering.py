@@ -12,103 +12,540 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import operator
+import heapq
+import math
 import time
 
-import Pyfhel
+import numpy as np
 
-from crypto import HE, PrivacySchemes, PRIVACY_SCHEME
+from dev.abstract_device import AbstractDevice
+from devicepool import DevicePool
+from privacy import DifferentialBackend, PrivacyBackend, default_backend
+from resolution import refined_merge, uniform_merge
+from sparse import SparseProfile, add_profile, as_profile
+from telemetry import IterationTelemetry, SteeringObserver
 
 
-def _get_sum(profiles: list) -> list[float]:
+def select_winner(improvements: list[float]) -> tuple[int | None, float]:
     """
-    Get the sum of the profiles
-    :type profiles: list[Pyfhel.PyCtxt] | list[list[float]]
-    :param profiles: list of profiles
-    :return: sum of the profiles
+    Select the device with the best improvement, ties are won by the first device
+    :param improvements: improvements, in the same order as the devices
+    :return: index of the winner (None if there is no improvement) and its improvement
     """
-    if PRIVACY_SCHEME == PrivacySchemes.HOMOMORPHIC:
-        if not isinstance(profiles[0], Pyfhel.PyCtxt):
-            raise TypeError("Profiles must be a list of Pyfhel.PyCtxt when using homomorphic encryption")
-        return sum(profiles)
-    elif PRIVACY_SCHEME == PrivacySchemes.DIFFERENTIAL:
-        if not isinstance(profiles[0], tuple) or not isinstance(profiles[0][0], list) or not isinstance(profiles[0][0][0], float):
-            raise TypeError("Profiles must be a nested list of floats when using differential privacy")
-        real_sum = list(map(sum, zip(*[profile[1] for profile in profiles])))
-        noisy_sum = list(map(sum, zip(*[profile[0] for profile in profiles])))
-
-        # plot the real sum and the noisy sum
-        import matplotlib.pyplot as plt
-        plt.plot(real_sum, label="real sum")
-        plt.plot(noisy_sum, label="noisy sum")
-        plt.plot(list(map(operator.sub, real_sum, noisy_sum)), label="difference")
-
-        plt.legend()
-        plt.show()
-
-        return noisy_sum
-
-
-class ProfileSteering:
-    def __init__(self, devices):
-        self.encrypted_sum = None
+    best_improvement = 0
+    best_index = None
+    for index, improvement in enumerate(improvements):
+        if improvement > best_improvement:
+            best_improvement = improvement
+            best_index = index
+    return best_index, best_improvement
+
+
+def _select_winners(improvements: list[float], winners: int | None, fraction: float | None) -> list[int]:
+    """
+    Select the devices that may accept their candidate in the same iteration
+    :param improvements: improvements, in the same order as the devices
+    :param winners: maximum number of winners, None for no maximum
+    :param fraction: only select devices with an improvement of at least this fraction of the best improvement
+    :return: indices of the winners, best first (ties are won by the first device)
+    """
+    best_index, best_improvement = select_winner(improvements)
+    if best_index is None:
+        return []
+    if winners == 1:
+        return [best_index]
+
+    selected = sorted((index for index, improvement in enumerate(improvements) if improvement > 0),
+                      key=lambda index: (-improvements[index], index))
+    if fraction is not None:
+        selected = [index for index in selected if improvements[index] >= fraction * best_improvement]
+    return selected[:winners]
+
+
+class _LazySelection:
+    """
+    Lazy winner selection with a max-heap of (stale) improvements, only devices that may still beat the leader are
+    planned again.
+
+    The improvement of a device is ||d|| - ||p_m - candidate||, where the second term is the distance between p_m and
+    the set of profiles the device can follow. When that set is convex, the distance at d' is at least the distance at
+    d minus <d' - d, u>, with u the unit vector from the candidate to p_m. Hence the improvement at d' is at most
+    e + ||d'|| - ||d|| + <d' - d, u>. The inner products are accumulated for all devices with one matrix product per
+    accepted diff. The bound holds for devices that plan an optimal candidate (e.g. the continuous buffer planning).
+    """
+
+    def __init__(self, devices: list[AbstractDevice], intervals: int):
         self.devices = devices
-        self.p = []  # p in the PS paper
-        self.x = []  # x in the PS paper
+        self.planned = [-1] * len(devices)  # iteration in which each device was planned last
+        self.improvements = np.full(len(devices), math.inf)  # unplanned devices go first
+        self.d_norms = np.zeros(len(devices))  # ||d|| at the moment each device was planned
+        self.slack = np.zeros(len(devices))  # accumulated <d' - d, u> since each device was planned
+        self.directions = np.zeros((len(devices), intervals))  # u of each device
+        self.plan_calls = 0
+
+    def select(self, iteration: int, d: list[float], latencies: dict[int, float] | None = None) \
+            -> tuple[int | None, float]:
+        """
+        Plan devices in order of their bound until the best bound belongs to a device planned in this iteration
+        :param iteration: index of the iteration
+        :param d: difference profile
+        :param latencies: if given, the plan time of each planned device is stored in it
+        :return: index of the winner (None if there is no improvement) and its improvement
+        """
+        d = np.asarray(d, dtype=np.float64)
+        d_norm = np.linalg.norm(d)
+        bounds = self.improvements - self.d_norms + d_norm + self.slack
+        heap = [(-bound, index) for index, bound in enumerate(bounds)]
+        heapq.heapify(heap)
+
+        while heap and self.planned[heap[0][1]] != iteration:
+            _, index = heapq.heappop(heap)
+            device = self.devices[index]
+            t1 = time.perf_counter()
+            improvement = device.plan(d, d_norm)
+            if latencies is not None:
+                latencies[index] = time.perf_counter() - t1
+            self.plan_calls += 1
 
-    def _decrypt_sum(self) -> list[float]:
+            residual = np.asarray(device.profile, dtype=np.float64) - d - np.asarray(device.candidate, dtype=np.float64)
+            residual_norm = np.linalg.norm(residual)
+            self.directions[index] = residual / residual_norm if residual_norm > 0 else 0
+            self.planned[index] = iteration
+            self.improvements[index] = improvement
+            self.d_norms[index] = d_norm
+            self.slack[index] = 0
+            heapq.heappush(heap, (-improvement, index))
+
+        if not heap or self.improvements[heap[0][1]] <= 0:
+            return None, 0
+        index = heap[0][1]
+        return index, self.improvements[index]
+
+    def accepted(self, index: int, change: list[float] | SparseProfile) -> None:
         """
-        Decrypt the encrypted sum and set the value of x
+        Register that the winner accepted its candidate
+        :param index: index of the winner
+        :param change: change of the difference profile d caused by the winner
         :return: None
         """
-        if PRIVACY_SCHEME == PrivacySchemes.HOMOMORPHIC:
-            # we have to trim the decrypted sum to the length of p because CKKS pads it to 2**13
-            return list(HE.decrypt(self.encrypted_sum)[:len(self.p)])
-        elif PRIVACY_SCHEME == PrivacySchemes.DIFFERENTIAL:
-            return self.encrypted_sum
+        if isinstance(change, SparseProfile):
+            self.slack += self.directions[:, change.window] @ change.values
+        else:
+            self.slack += self.directions @ np.asarray(change, dtype=np.float64)
+
+        # The profile of the winner changed, so its old improvement is no bound anymore
+        self.planned[index] = -1
+        self.improvements[index] = math.inf
+
+
+class ProfileSteering(AbstractDevice):
+    """
+    Profile steering over a list of devices.
+    An instance is a device itself, such that it can be steered by a parent instance, e.g. per feeder or neighbourhood.
+    Then every plan request of the parent runs a local steering round, and only the aggregated diff is sent up.
+    """
+
+    def __init__(self, devices, processes: int | None = None, batched: bool = False, lazy: bool = False,
+                 winners: int | None = 1, winner_fraction: float | None = None,
+                 observers: list[SteeringObserver] | None = None, private_updates: bool = False,
+                 backend: PrivacyBackend | None = None):
+        """
+        :param devices: devices to steer
+        :param processes: number of worker processes used to plan the devices and to aggregate the initial profiles,
+        None does both in this process
+        :param batched: plan devices of the same type together with their plan_batch implementation
+        :param lazy: only plan the devices that may still beat the best improvement, see _LazySelection
+        :param winners: maximum number of devices that accept their candidate per iteration, None for no maximum
+        :param winner_fraction: only let devices win that improve at least this fraction of the best improvement
+        :param observers: receive the telemetry of init and of every iteration, see telemetry.py
+        :param private_updates: winners send their diff in private representation, which updates the aggregate. The
+        aggregate is only decoded when a new difference profile has to be broadcast. Not supported with differential
+        privacy, since every update would add fresh noise to x.
+        :param backend: privacy backend, defaults to the privacy scheme selected with PS_PRIVACY_SCHEME
+        """
+        if lazy and (processes or batched):
+            raise ValueError("Lazy selection plans devices one by one and cannot be combined with processes or batched")
+        if lazy and winners != 1:
+            raise ValueError("Lazy selection only determines a single winner per iteration")
+        if lazy and any(isinstance(device, ProfileSteering) for device in devices):
+            # The bounds only hold when a candidate is the optimal projection of p_m onto the feasible set of a device,
+            # the candidate of a sub-aggregator is the diff of its local winners
+            raise ValueError("Lazy selection cannot be used with sub-aggregators as devices")
+        if private_updates and winners != 1:
+            raise ValueError("Verifying several winners needs their plaintext diffs, use a single winner")
+
+        self.encrypted_sum = None
+        self.devices = devices
+        self.processes = processes
+        self.batched = batched
+        self.lazy = lazy
+        self.winners = winners
+        self.winner_fraction = winner_fraction
+        self.observers = list(observers) if observers else []
+        self.private_updates = private_updates
+        self.backend = backend if backend is not None else default_backend()
+        if private_updates and isinstance(self.backend, DifferentialBackend):
+            # The noise of every accepted diff adds up in x, so the loop steers towards a drifting target
+            raise ValueError("Private updates cannot be combined with differential privacy, the noise accumulates")
+        self.p = []  # p in the PS paper
+        self.x = []  # x in the PS paper
+        self.flexible_indices = list(range(len(devices)))  # indices of the devices planned in the iterative loop
+        self._pool = None  # worker processes that own the devices when planning with processes, see close
+
+        # Local steering round when this instance is steered as a device, see plan_candidate
+        self.selected = []  # indices of the local winners
+        self.selected_diff = np.zeros(0)  # change of x when the local winners accept their candidates
+
+        # Statistics of the last call to init or advance
+        self.aggregation_time = 0.0
+        self.decryption_time = 0.0
+
+        # Statistics of the last call to iterative
+        self.iterations = 0
+        self.iteration_times = []
+        self.plan_calls = 0
+        self.wall_time = 0.0
+        self.objective = 0.0  # ||x - p||
 
     def init(self, p):
+        # The devices are initialized here, a new pool is started by the next call to iterative
+        self.close()
+
         # Set the desired profile and reset xrange
-        self.p = list(p)
-        self.x = [0] * len(p)
+        self.p = np.array(p, dtype=np.float64)
+        self.x = np.zeros(len(p))
 
         # Ask all devices to propose an initial planning
-        initial_profiles = [device.init(p) for device in self.devices]
-        self.encrypted_sum = _get_sum(initial_profiles)
-        self.x = self._decrypt_sum()
+        self._aggregate(self.backend.encode_fleet(self.devices, p))
+        return self.x
+
+    def advance(self, desired: list[float]) -> np.ndarray:
+        """
+        Receding horizon: moves the planning window forward by len(desired) intervals.
+        The devices execute the first intervals of their accepted profile, and keep the rest as starting point for the
+        next call to iterative. This starting point is close to optimal, so only a few iterations are needed.
+        :param desired: desired profile of the new intervals at the end of the window
+        :return: x over the new window
+        """
+        steps = len(desired)
+        if not 0 < steps <= len(self.p):
+            raise ValueError("The window can only be moved forward by 1 up to %d intervals" % len(self.p))
 
+        self.p = np.concatenate((self.p[steps:], np.asarray(desired, dtype=np.float64)))
+        if self._pool is not None:
+            self._aggregate(self._pool.shift_private(steps, self.backend))
+        else:
+            self._aggregate([device.shift_private(steps, self.backend) for device in self.devices])
         return self.x
 
+    def close(self) -> None:
+        """
+        Stops the worker processes, if any, and takes over the state the devices have in them.
+        An instance that plans with processes keeps its workers across calls to iterative, advance and
+        multiresolution, so it should be closed when done. When a worker died, RuntimeError is raised and init has to
+        be called again.
+        :return: None
+        """
+        if self._pool is None:
+            return
+        pool = self._pool
+        self._pool = None
+        self.devices = list(pool.close())
+
+    def _set_interval_merge(self, intervalMerge) -> None:
+        """
+        Sets the resolution of the flexible devices, in the workers when planning with processes
+        :param intervalMerge: intervalMerge vector, None for full resolution
+        :return: None
+        """
+        pool = self._device_pool()
+        if pool is not None:
+            pool.set_interval_merge(intervalMerge)
+        else:
+            for i in self.flexible_indices:
+                self.devices[i].set_interval_merge(intervalMerge)
+
+    def _device_pool(self) -> DevicePool | None:
+        """
+        Worker processes that own the devices, started on first use
+        :return: pool, None when planning in this process
+        """
+        if self._pool is None and self.processes:
+            self._pool = DevicePool(self.devices, len(self.p), self.processes, self.batched)
+            self._pool.flexible()
+        return self._pool
+
+    def _aggregate(self, representations: list) -> None:
+        """
+        Set x to the aggregate of the profiles of all devices
+        :param representations: private representations of the profiles, see PrivacyBackend.encode_fleet
+        :return: None
+        """
+        t1 = time.time()
+        self.encrypted_sum = self.backend.aggregate(representations, self.processes)
+        t2 = time.time()
+        self.x = np.array(self.backend.decode(self.encrypted_sum, len(self.p)), dtype=np.float64)
+        self.aggregation_time = t2 - t1
+        self.decryption_time = time.time() - t2
+        for observer in self.observers:
+            observer.on_init(self.aggregation_time, self.decryption_time)
+
+        # Devices without flexibility only contribute a static baseline, which is part of x from here on.
+        # They are left out of the iterative loop.
+        if self._pool is not None:
+            self.flexible_indices = self._pool.flexible()
+        else:
+            self.flexible_indices = [i for i, device in enumerate(self.devices) if device.is_flexible()]
+        self.selected = []
+        self.selected_diff = np.zeros(len(self.p))
+
+    def _verify_winners(self, selected: list[int], devices: list[AbstractDevice], pool: DevicePool | None,
+                        d: np.ndarray) -> list[int]:
+        """
+        The candidates of the winners are all planned against the same d, so accepting all of them may overshoot.
+        Winners are added in order of their improvement, as long as each one lowers ||x - p|| further.
+        :param selected: indices of the winners, best first
+        :param devices: devices
+        :param pool: worker processes that own the devices, if any
+        :param d: difference profile the candidates are planned against
+        :return: indices of the winners that may accept their candidate
+        """
+        residual = d.copy()  # x - p after accepting the winners so far
+        accepted = []
+        for index in selected:
+            diff = np.asarray(devices[index].candidate_diff() if pool is None
+                              else pool.candidate_diff(self.flexible_indices[index]))
+            if accepted and np.linalg.norm(residual + diff) >= np.linalg.norm(residual):
+                continue
+            residual += diff
+            accepted.append(index)
+        return accepted
+
+    @staticmethod
+    def _plan(devices: list[AbstractDevice], d: np.ndarray, latencies: dict[int, float] | None,
+              d_norm: float) -> list[float]:
+        """
+        Request a new candidate profile from each device, one by one
+        :param devices: devices
+        :param d: difference profile
+        :param latencies: if given, the plan time of each device is stored in it
+        :param d_norm: ||d||, shared by all devices
+        :return: improvements, in the same order as the devices
+        """
+        if latencies is None:
+            return [device.plan(d, d_norm) for device in devices]
+
+        improvements = []
+        for index, device in enumerate(devices):
+            t1 = time.perf_counter()
+            improvements.append(device.plan(d, d_norm))
+            latencies[index] = time.perf_counter() - t1
+        return improvements
+
     def iterative(self, e_min, max_iters):
-        # Iterative Loop
-        for i in range(0, max_iters):  # Note we deviate here slightly by also definint a maximum number of iterations
-            t1 = time.time()
-            # Init
-            best_improvement = 0
-            best_device = None
-
-            # difference profile
-            d = list(map(operator.sub, self.x, self.p))  # d = x - p
-
-            # request a new candidate profile from each device
-            for device in self.devices:
-                improvement = device.plan(d)
-                if improvement > best_improvement:
-                    best_improvement = improvement
-                    best_device = device
-
-            # Now set the winner (best scoring device) and update the planning
-            if best_device is not None:
-                diff = best_device.accept()
-                self.x = list(map(operator.sub, self.x, diff))
-
-            t2 = time.time()
-            time_diff = t2 - t1
-            print("Iteration", i, "-- Winner", best_device, "Improvement", best_improvement, "Time", round(time_diff, 5))
-            # print("Overall Profile", self.x)
-
-            # Now check id the improvement is good enough
-            if best_improvement < e_min:
-                break  # Break the loop
+        devices = [self.devices[i] for i in self.flexible_indices]
+        start = time.time()
+        self.iteration_times = []
+        self.plan_calls = 0
+
+        # When planning in parallel the devices live in the workers, until close is called
+        pool = self._device_pool()
+        lazy = _LazySelection(devices, len(self.p)) if self.lazy else None
+
+        # difference profile, updated in place together with x. Devices get a read-only view on it
+        d = np.subtract(self.x, self.p)  # d = x - p
+        d_view = d.view()
+        d_view.flags.writeable = False
+
+        try:
+            # Iterative Loop
+            for i in range(0, max_iters):  # Note we deviate here slightly by also definint a maximum number of iterations
+                t1 = time.time()
+                self.iterations = i + 1
+                plan_calls = self.plan_calls
+
+                # Measuring each device is only done when someone is listening
+                latencies = {} if self.observers else None
+
+                # request a new candidate profile from each device
+                if lazy is not None:
+                    best_index, best_improvement = lazy.select(i, d_view, latencies)
+                    selected = [best_index] if best_index is not None else []
+                    self.plan_calls = lazy.plan_calls
+                else:
+                    # ||d|| is the same for all devices, so it is only calculated once per iteration
+                    d_norm = np.linalg.norm(d)
+                    if pool is not None:
+                        improvements = pool.plan(d, latencies, d_norm)
+                    elif self.batched:
+                        improvements = AbstractDevice.plan_grouped(devices, d_view, latencies, d_norm)
+                    else:
+                        improvements = self._plan(devices, d_view, latencies, d_norm)
+                    self.plan_calls += len(devices)
+                    selected = _select_winners(improvements, self.winners, self.winner_fraction)
+                    best_improvement = improvements[selected[0]] if selected else 0
+                    if len(selected) > 1:
+                        selected = self._verify_winners(selected, devices, pool, d)
+                best_device = devices[selected[0]] if selected else None
+                t2 = time.time()
+
+                # Now set the winners (best scoring devices) and update the planning
+                decryption_time = 0.0
+                if self.private_updates:
+                    for index in selected:
+                        update = devices[index].accept_private(self.backend) if pool is None \
+                            else pool.accept_private(self.flexible_indices[index], self.backend)
+                        self.encrypted_sum = self.backend.update(self.encrypted_sum, update)  # x = x + (^x_m - x_m)
+                    if selected:
+                        # Only decode when the new difference profile has to be broadcast
+                        t4 = time.time()
+                        diff = np.subtract(self.backend.decode(self.encrypted_sum, len(self.p)), self.x)
+                        decryption_time = time.time() - t4
+                        self.x += diff
+                        d += diff
+                        if lazy is not None:
+                            lazy.accepted(selected[0], diff)
+                else:
+                    for index in selected:
+                        # Devices such as EVs send a sparse diff, which only touches their window of x and d
+                        diff = as_profile(devices[index].accept() if pool is None
+                                           else pool.accept(self.flexible_indices[index]))
+                        add_profile(self.x, diff)  # x = x + (^x_m - x_m)
+                        add_profile(d, diff)
+                        if lazy is not None:
+                            lazy.accepted(index, diff)
+
+                t3 = time.time()
+                self.iteration_times.append(t3 - t1)
+                self.objective = float(np.linalg.norm(d))
+                if self.observers:
+                    telemetry = IterationTelemetry(i, best_device, [devices[index] for index in selected],
+                                                   best_improvement, self.objective, t3 - t1, t2 - t1,
+                                                   {self.flexible_indices[index]: latency for index, latency in
+                                                    latencies.items()},
+                                                   self.plan_calls - plan_calls, t3 - t2 - decryption_time,
+                                                   decryption_time)
+                    for observer in self.observers:
+                        observer.on_iteration(telemetry)
+
+                # Now check id the improvement is good enough
+                if best_improvement < e_min:
+                    break  # Break the loop
+        finally:
+            self.wall_time = time.time() - start
 
+        for observer in self.observers:
+            observer.on_finish(self.iterations, self.objective, self.wall_time)
         return self.x  # Return the profile
+
+    def multiresolution(self, e_min, max_iters, factor: int, near_term: int = 0, refine: float = 0.0) -> np.ndarray:
+        """
+        Coarse-to-fine steering for long horizons. First the devices are steered with every factor intervals merged,
+        see resolution.py. Then the near-term intervals and the merged intervals with the largest residual are
+        planned at full resolution, starting from the coarse profiles. Other intervals stay merged.
+        The improvements are always calculated at full resolution. Call init first.
+        :param e_min: minimum improvement, like in iterative
+        :param max_iters: maximum number of iterations of each phase
+        :param factor: number of intervals per merged interval
+        :param near_term: number of intervals at the start of the horizon that are refined
+        :param refine: fraction of the merged intervals that is refined, by largest ||x - p|| within them
+        :return: x
+        """
+        iterations = 0
+        iteration_times = []
+        plan_calls = 0
+        wall_time = 0.0
+        try:
+            for refined in (False, True):
+                merge = refined_merge(self.x - self.p, factor, near_term, refine) if refined \
+                    else uniform_merge(len(self.p), factor)
+                self._set_interval_merge(merge)
+
+                self.iterative(e_min, max_iters)
+                iterations += self.iterations
+                iteration_times += self.iteration_times
+                plan_calls += self.plan_calls
+                wall_time += self.wall_time
+        finally:
+            self._set_interval_merge(None)
+
+        # Statistics of both phases together
+        self.iterations = iterations
+        self.iteration_times = iteration_times
+        self.plan_calls = plan_calls
+        self.wall_time = wall_time
+        return self.x
+
+    # Steering this instance as a device of a parent ProfileSteering instance.
+    # The desired profile of this sub-tree is p_m = x - d, hence the local difference profile is the d of the parent.
+
+    @property
+    def profile(self) -> np.ndarray:
+        return self.x
+
+    @property
+    def candidate(self) -> np.ndarray:
+        return self.x + self.selected_diff
+
+    def is_flexible(self) -> bool:
+        return len(self.flexible_indices) > 0
+
+    def shift(self, steps: int) -> np.ndarray:
+        # The desired profile of this instance is not used as a device, so it is padded with zeros
+        return self.advance([0.0] * steps)
+
+    def set_interval_merge(self, intervalMerge: np.ndarray | None) -> None:
+        for i in self.flexible_indices:
+            self.devices[i].set_interval_merge(intervalMerge)
+
+    def plan_candidate(self, d: np.ndarray) -> None:
+        """
+        Local steering round: the flexible devices plan against d and the local winners are selected, like in an
+        iteration of iterative. The winners only accept their candidates when this instance wins at the parent.
+        :param d: difference profile of the parent
+        :return: None
+        """
+        if self.lazy or self.processes:
+            raise ValueError("Steered as a device, the devices are planned in this process and without lazy selection."
+                             " Let the parent plan in worker processes instead.")
+
+        devices = [self.devices[i] for i in self.flexible_indices]
+        d_view = d.view()
+        d_view.flags.writeable = False
+        d_norm = np.linalg.norm(d)
+        if self.batched:
+            improvements = AbstractDevice.plan_grouped(devices, d_view, None, d_norm)
+        else:
+            improvements = self._plan(devices, d_view, None, d_norm)
+        self.plan_calls += len(devices)
+
+        selected = _select_winners(improvements, self.winners, self.winner_fraction)
+        if len(selected) > 1:
+            selected = self._verify_winners(selected, devices, None, d)
+
+        self.selected = [self.flexible_indices[index] for index in selected]
+        self.selected_diff = np.zeros(len(self.x))
+        for index in self.selected:
+            add_profile(self.selected_diff, as_profile(self.devices[index].candidate_diff()))
+
+    def improvement(self, d: np.ndarray, d_norm: float) -> float:
+        # ||d||^2 - ||d + diff||^2, divided by the sum of the norms like in AbstractDevice.improvement
+        diff = self.selected_diff
+        difference = -np.dot(diff, diff) - 2 * np.dot(diff, d)
+        candidate_norm = np.sqrt(max(d_norm * d_norm - difference, 0.0))
+        if d_norm + candidate_norm == 0:
+            return 0.0
+        return float(difference / (d_norm + candidate_norm))
+
+    def candidate_diff(self) -> np.ndarray:
+        return self.selected_diff.copy()
+
+    def accept(self) -> np.ndarray:
+        # The local winners accept their candidates, only the aggregated diff is sent to the parent
+        diff = np.zeros(len(self.x))
+        for index in self.selected:
+            add_profile(diff, as_profile(self.devices[index].accept()))
+        self.x += diff
+        self.selected = []
+        self.selected_diff = np.zeros(len(self.x))
+        return diff
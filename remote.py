@@ -0,0 +1,377 @@
+#!/usr/bin/python3
+
+# Copyright 2023 University of Twente
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Devices that run as separate agents, e.g. on home gateways, reached over a TCP or Unix socket.
+# DeviceAgent serves a device, RemoteDevice is its proxy at the aggregator, and AsyncProfileSteering steers a fleet of
+# proxies with asyncio. Agents that do not answer a plan request before the deadline are left out of the iteration,
+# such that the latency of an iteration is bounded by the deadline instead of by the slowest agent.
+#
+# Every message is a header (command or status, a scalar and the number of values) followed by float64 values.
+#
+# Usage example, many local agents in one process:
+#   python remote.py
+
+import asyncio
+import struct
+import time
+import traceback
+from enum import IntEnum
+
+import numpy as np
+
+from dev.abstract_device import AbstractDevice
+from profilesteering import select_winner
+from sparse import as_profile
+from telemetry import IterationTelemetry, SteeringObserver
+
+_HEADER = struct.Struct("!BdI")  # command or status, scalar, number of float64 values that follow
+_VALUE = np.dtype("<f8")
+
+
+class Command(IntEnum):
+    INIT = 1
+    PLAN = 2
+    ACCEPT = 3
+    FLEXIBLE = 4
+
+
+class Status(IntEnum):
+    OK = 0
+    ERROR = 1
+
+
+async def _send(writer: asyncio.StreamWriter, code: int, value: float = 0.0, values=None) -> None:
+    values = np.ascontiguousarray(np.zeros(0) if values is None else np.asarray(values), dtype=_VALUE)
+    writer.write(_HEADER.pack(code, value, len(values)) + values.tobytes())
+    await writer.drain()
+
+
+async def _receive(reader: asyncio.StreamReader) -> tuple[int, float, np.ndarray]:
+    code, value, count = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+    values = np.frombuffer(await reader.readexactly(count * _VALUE.itemsize), dtype=_VALUE) if count else np.zeros(0)
+    return code, value, values
+
+
+class DeviceAgent:
+    """
+    Serves a device over a socket, the device methods run in the event loop of the agent
+    """
+
+    def __init__(self, device: AbstractDevice, latency: float = 0.0):
+        """
+        :param device: device to serve
+        :param latency: extra delay before every answer to a plan request in seconds, to emulate slow agents
+        """
+        self.device = device
+        self.latency = latency
+        self.server = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0, path: str | None = None) -> tuple | str:
+        """
+        Starts listening for an aggregator
+        :param host: host to listen on
+        :param port: TCP port, 0 picks a free port
+        :param path: path of a Unix socket, instead of TCP
+        :return: address to connect to, see RemoteDevice.connect
+        """
+        if path is not None:
+            self.server = await asyncio.start_unix_server(self._serve, path=path)
+            return path
+        self.server = await asyncio.start_server(self._serve, host, port)
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def close(self) -> None:
+        """
+        Stops listening
+        :return: None
+        """
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                command, value, values = await _receive(reader)
+                try:
+                    scalar, profile = await self._execute(command, value, values)
+                except Exception:
+                    # The aggregator raises an error as well, the agent keeps serving
+                    traceback.print_exc()
+                    await _send(writer, Status.ERROR)
+                    continue
+                await _send(writer, Status.OK, scalar, profile)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass  # the aggregator disconnected
+        finally:
+            writer.close()
+
+    async def _execute(self, command: int, value: float, values: np.ndarray) -> tuple[float, np.ndarray | None]:
+        device = self.device
+        if command == Command.INIT:
+            return 0.0, device.init(values.tolist())
+        elif command == Command.PLAN:
+            improvement = device.plan(values, value)
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            return improvement, None
+        elif command == Command.ACCEPT:
+            return 0.0, np.asarray(as_profile(device.accept()))
+        elif command == Command.FLEXIBLE:
+            return float(device.is_flexible()), None
+        raise ValueError("Unknown command %d" % command)
+
+
+class RemoteDevice:
+    """
+    Proxy of a device that is served by a DeviceAgent, requests on the same proxy are answered in order
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self._lock = asyncio.Lock()
+
+    @classmethod
+    async def connect(cls, address: tuple | str) -> "RemoteDevice":
+        """
+        Connects to an agent
+        :param address: (host, port) of a TCP socket or the path of a Unix socket, see DeviceAgent.start
+        :return: proxy
+        """
+        if isinstance(address, str):
+            reader, writer = await asyncio.open_unix_connection(address)
+        else:
+            reader, writer = await asyncio.open_connection(*address)
+        return cls(reader, writer)
+
+    async def _request(self, command: Command, value: float = 0.0, values=None) -> tuple[float, np.ndarray]:
+        async with self._lock:
+            await _send(self.writer, command, value, values)
+            status, value, values = await _receive(self.reader)
+        if status != Status.OK:
+            raise RuntimeError("Remote device failed on %s, see the log of its agent" % command.name)
+        return value, values
+
+    async def init(self, p: list[float]) -> np.ndarray:
+        return (await self._request(Command.INIT, values=p))[1]
+
+    async def plan(self, d: np.ndarray, d_norm: float) -> float:
+        return (await self._request(Command.PLAN, d_norm, d))[0]
+
+    async def accept(self) -> np.ndarray:
+        return (await self._request(Command.ACCEPT))[1]
+
+    async def is_flexible(self) -> bool:
+        return bool((await self._request(Command.FLEXIBLE))[0])
+
+    async def close(self) -> None:
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+class AsyncProfileSteering:
+    """
+    Profile steering over remote devices. Plan requests are sent to all agents at once, and the winner is the best
+    device among the agents that answered before the deadline. The answer of an agent that missed the deadline is
+    still used in a later iteration when d has not changed since, which is why a winner that improves less than e_min
+    is only accepted when all agents answered. The profiles are sent in plain text.
+    """
+
+    def __init__(self, devices: list[RemoteDevice], deadline: float | None = None,
+                 observers: list[SteeringObserver] | None = None):
+        """
+        :param devices: proxies of the devices to steer
+        :param deadline: time in seconds that agents get to answer a plan request, None waits for all agents
+        :param observers: receive the telemetry of init and of every iteration, see telemetry.py
+        """
+        self.devices = devices
+        self.deadline = deadline
+        self.observers = list(observers) if observers else []
+        self.p = []  # p in the PS paper
+        self.x = []  # x in the PS paper
+        self.flexible_indices = list(range(len(devices)))  # indices of the devices planned in the iterative loop
+        self._pending = {}  # unanswered plan request per device index, with the version of d it was planned against
+        self._version = 0  # number of accepted winners, d only changes when a winner accepts
+
+        # Statistics of the last call to iterative
+        self.iterations = 0
+        self.iteration_times = []
+        self.plan_calls = 0
+        self.timeouts = 0  # plan requests that were not answered before the deadline
+        self.wall_time = 0.0
+        self.objective = 0.0  # ||x - p||
+
+    async def init(self, p: list[float]) -> np.ndarray:
+        self.p = np.array(p, dtype=np.float64)
+        self._version += 1  # answers of stragglers are planned against the previous d
+
+        t1 = time.time()
+        profiles = await asyncio.gather(*(device.init(p) for device in self.devices))
+        self.x = np.sum(profiles, axis=0, dtype=np.float64) if profiles else np.zeros(len(p))
+        flexible = await asyncio.gather(*(device.is_flexible() for device in self.devices))
+        self.flexible_indices = [i for i, is_flexible in enumerate(flexible) if is_flexible]
+        for observer in self.observers:
+            observer.on_init(time.time() - t1, 0.0)
+        return self.x
+
+    async def _plan(self, d: np.ndarray, latencies: dict[int, float] | None) -> dict[int, float]:
+        """
+        Request a new candidate profile from every flexible device that is not still busy with an earlier request.
+        Late answers to earlier requests are used as well, as long as d did not change since.
+        :param d: difference profile
+        :param latencies: if given, the answer time of each device that answered a new request is stored in it
+        :return: improvements of the devices that answered before the deadline, keyed on their index
+        """
+        improvements = self._late_answers()
+
+        d_norm = float(np.linalg.norm(d))
+        start = time.perf_counter()
+        answered = {}  # answer time of each device
+        tasks = {}
+        for index in self.flexible_indices:
+            if index in self._pending or index in improvements:
+                continue  # still busy with an earlier request, or answered it already
+            task = asyncio.ensure_future(self.devices[index].plan(d, d_norm))
+            task.add_done_callback(lambda _, index=index: answered.setdefault(index, time.perf_counter() - start))
+            tasks[task] = index
+        self.plan_calls += len(tasks)
+
+        # The stragglers get the same deadline, such that their connections are freed when they answer
+        waiting = list(tasks) + [task for task, _ in self._pending.values()]
+        if not waiting:
+            return improvements
+        done, pending = await asyncio.wait(waiting, timeout=self.deadline)
+        improvements.update((tasks[task], task.result()) for task in done if task in tasks)
+        improvements.update(self._late_answers())
+        if latencies is not None:
+            latencies.update((index, answered[index]) for index in improvements if index in answered)
+
+        # Stragglers keep their connection busy until they answer, they are skipped until then
+        for task in pending:
+            if task in tasks:
+                self._pending[tasks[task]] = (task, self._version)
+        self.timeouts += sum(task in tasks for task in pending)
+        return improvements
+
+    def _late_answers(self) -> dict[int, float]:
+        """
+        Collects the answers of stragglers. An answer is only used when no winner accepted since the request, then it
+        was planned against the current d. Errors of stragglers are raised here.
+        :return: improvements of the stragglers with a valid answer, keyed on their index
+        """
+        improvements = {}
+        for index, (task, version) in list(self._pending.items()):
+            if task.done():
+                del self._pending[index]
+                improvement = task.result()
+                if version == self._version:
+                    improvements[index] = improvement
+        return improvements
+
+    async def iterative(self, e_min, max_iters) -> np.ndarray:
+        start = time.time()
+        self.iteration_times = []
+        self.plan_calls = 0
+        self.timeouts = 0
+        d = np.subtract(self.x, self.p)  # d = x - p
+
+        for i in range(0, max_iters):
+            t1 = time.time()
+            self.iterations = i + 1
+            plan_calls = self.plan_calls
+            latencies = {} if self.observers else None
+
+            # request a new candidate profile from each device, and take the best one that answered in time
+            improvements = await self._plan(d, latencies)
+            answered = sorted(improvements)
+            complete = len(answered) == len(self.flexible_indices)  # every agent answered against this d
+            best_index, best_improvement = select_winner([improvements[index] for index in answered])
+            if best_index is not None:
+                best_index = answered[best_index]
+            if best_improvement < e_min and not complete:
+                # Not worth changing d, such that the late answers of the stragglers stay valid
+                best_index, best_improvement = None, 0
+            t2 = time.time()
+
+            # The winner has answered, so its connection is free and it accepts the candidate it just planned
+            if best_index is not None:
+                diff = await self.devices[best_index].accept()
+                self.x += diff  # x = x + (^x_m - x_m)
+                d += diff
+                self._version += 1
+
+            t3 = time.time()
+            self.iteration_times.append(t3 - t1)
+            self.objective = float(np.linalg.norm(d))
+            if self.observers:
+                best_device = self.devices[best_index] if best_index is not None else None
+                telemetry = IterationTelemetry(i, best_device, [best_device] if best_device is not None else [],
+                                               best_improvement, self.objective, t3 - t1, t2 - t1, latencies,
+                                               self.plan_calls - plan_calls, t3 - t2, 0.0)
+                for observer in self.observers:
+                    observer.on_iteration(telemetry)
+
+            # Now check if the improvement is good enough. Agents that missed the deadline, or that answered against an
+            # earlier d, may still improve, so the loop only stops when every agent has answered against this d.
+            if best_improvement < e_min and complete:
+                break
+
+        self.wall_time = time.time() - start
+        for observer in self.observers:
+            observer.on_finish(self.iterations, self.objective, self.wall_time)
+        return self.x
+
+    async def close(self) -> None:
+        """
+        Waits for the stragglers and disconnects from all agents
+        :return: None
+        """
+        await asyncio.gather(*(task for task, _ in self._pending.values()), return_exceptions=True)
+        self._pending = {}
+        await asyncio.gather(*(device.close() for device in self.devices))
+
+
+async def _main():
+    import random
+
+    from dev.battery import Battery
+    from dev.electricvehicle import ElectricVehicle
+    from dev.heatpump import HeatPump
+    from dev.load import Load
+    from telemetry import PrintObserver
+
+    # Local agents, a few of them answer late
+    devices = [Load() for i in range(5)] + [Battery() for i in range(5)] + [ElectricVehicle() for i in range(5)] + \
+              [HeatPump() for i in range(5)]
+    agents = [DeviceAgent(device, latency=0.5 if random.random() < 0.2 else 0.0) for device in devices]
+    addresses = [await agent.start() for agent in agents]
+
+    proxies = [await RemoteDevice.connect(address) for address in addresses]
+    ps = AsyncProfileSteering(proxies, deadline=0.1, observers=[PrintObserver()])
+    await ps.init([0] * 96)
+    await ps.iterative(0.001, 1000)
+    print("Plan requests", ps.plan_calls, "-- Missed the deadline", ps.timeouts)
+
+    await ps.close()
+    for agent in agents:
+        await agent.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
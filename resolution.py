@@ -0,0 +1,90 @@
+# Copyright 2023 University of Twente
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Planning at a coarser resolution, with the intervalMerge vectors of OptAlg.
+# An intervalMerge vector holds the number of intervals of each merged interval, and sums to the horizon length.
+# Profiles are merged by averaging over each merged interval, and expanded again by repeating the merged values.
+
+import numpy as np
+
+
+def uniform_merge(intervals: int, factor: int) -> np.ndarray:
+    """
+    Merges every factor intervals, the last merged interval may be shorter
+    :param intervals: number of intervals of the horizon
+    :param factor: number of intervals per merged interval
+    :return: intervalMerge vector
+    """
+    merge = np.full(intervals // factor, factor, dtype=int)
+    if intervals % factor:
+        merge = np.append(merge, intervals % factor)
+    return merge
+
+
+def refined_merge(d: np.ndarray, factor: int, near_term: int = 0, refine: float = 0.0) -> np.ndarray:
+    """
+    Merges every factor intervals, except for the near-term intervals and the merged intervals with the largest
+    residual, which are kept at full resolution
+    :param d: difference profile x - p
+    :param factor: number of intervals per merged interval
+    :param near_term: number of intervals at the start of the horizon that are kept at full resolution
+    :param refine: fraction of the merged intervals that is kept at full resolution, by largest ||d|| within them
+    :return: intervalMerge vector
+    """
+    merge = uniform_merge(len(d), factor)
+    starts = np.concatenate(([0], np.cumsum(merge)[:-1]))
+    fine = starts < near_term
+
+    count = int(round(refine * len(merge)))
+    if count > 0:
+        residual = np.add.reduceat(np.square(d), starts)
+        fine[np.argsort(-residual, kind='stable')[:count]] = True
+
+    return np.concatenate([np.ones(length, dtype=int) if keep else [length] for keep, length in zip(fine, merge)])
+
+
+def window_merge(intervalMerge: np.ndarray, start: int, end: int) -> np.ndarray:
+    """
+    Part of an intervalMerge vector within a window, merged intervals that cross the boundaries are cut off
+    :param intervalMerge: intervalMerge vector of the horizon
+    :param start: first interval of the window
+    :param end: end of the window (exclusive)
+    :return: intervalMerge vector of the window
+    """
+    bounds = np.cumsum(intervalMerge)
+    bounds = bounds[(bounds > start) & (bounds < end)]
+    return np.diff(np.concatenate(([start], bounds, [end]))) if end > start else np.zeros(0, dtype=int)
+
+
+def merge_profile(profile: np.ndarray, intervalMerge: np.ndarray) -> np.ndarray:
+    """
+    Average of a profile over each merged interval
+    :param profile: profile at full resolution
+    :param intervalMerge: intervalMerge vector
+    :return: merged profile
+    """
+    if len(intervalMerge) == 0:
+        return np.zeros(0)
+    starts = np.concatenate(([0], np.cumsum(intervalMerge)[:-1]))
+    return np.add.reduceat(np.asarray(profile, dtype=np.float64), starts) / intervalMerge
+
+
+def expand_profile(values: list[float], intervalMerge: np.ndarray) -> np.ndarray:
+    """
+    Profile at full resolution, constant within each merged interval
+    :param values: merged profile
+    :param intervalMerge: intervalMerge vector
+    :return: profile at full resolution
+    """
+    return np.repeat(np.asarray(values, dtype=np.float64), intervalMerge)
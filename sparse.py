@@ -0,0 +1,99 @@
+# Copyright 2023 University of Twente
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+
+
+class SparseProfile:
+    """
+    Profile that is zero outside the window [offset, offset + len(values)), e.g. of a device that is only connected
+    during part of the horizon. np.asarray converts it to the full-length profile.
+    """
+    __slots__ = ('length', 'offset', 'values')
+
+    def __init__(self, length: int, offset: int = 0, values: np.ndarray | None = None):
+        self.length = length  # number of intervals of the full profile
+        self.offset = offset  # first interval of the window
+        self.values = np.zeros(0) if values is None else np.asarray(values, dtype=np.float64)  # values in the window
+
+    @property
+    def window(self) -> slice:
+        return slice(self.offset, self.offset + len(self.values))
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        dense = np.zeros(self.length, dtype=np.float64 if dtype is None else dtype)
+        dense[self.window] = self.values
+        return dense
+
+    def add_to(self, target: np.ndarray) -> np.ndarray:
+        """
+        Adds the profile to a full-length profile in place, only the window is touched
+        :param target: full-length profile
+        :return: target
+        """
+        target[self.window] += self.values
+        return target
+
+
+def as_profile(profile) -> SparseProfile | np.ndarray:
+    """
+    Profile as returned by a device, sparse profiles are kept as they are
+    :param profile: sparse or full-length profile
+    :return: sparse profile, or full-length profile as float64 array
+    """
+    if isinstance(profile, SparseProfile):
+        return profile
+    return np.asarray(profile, dtype=np.float64)
+
+
+def add_profile(target: np.ndarray, profile: SparseProfile | np.ndarray) -> np.ndarray:
+    """
+    Adds a sparse or full-length profile to a full-length profile in place, e.g. a diff to x
+    :param target: full-length profile
+    :param profile: profile to add
+    :return: target
+    """
+    if isinstance(profile, SparseProfile):
+        return profile.add_to(target)
+    target += profile
+    return target
+
+
+def sparse_improvement(d: np.ndarray, profile: SparseProfile, candidate: SparseProfile,
+                       d_norm: float | None = None) -> float:
+    """
+    Improvement ||x_m - p_m|| - ||^x_m - p_m|| of a candidate with the same window as the profile, with p_m = x_m - d.
+    Outside the window ^x_m - p_m equals d, so only the window and ||d|| are needed.
+    The difference of the norms is calculated as a difference of squares, which does not cancel out when the
+    improvement is small compared to ||d||.
+    :param d: difference profile
+    :param profile: profile of the device
+    :param candidate: candidate profile of the device, with the same window as the profile
+    :param d_norm: ||d||, calculated when not given
+    :return: improvement
+    """
+    d_window = d[profile.window]
+    residual = candidate.values - profile.values + d_window  # ^x_m - p_m within the window
+    if d_norm is None:
+        d_norm = np.linalg.norm(d)
+
+    d_window_squared = np.dot(d_window, d_window)
+    residual_squared = np.dot(residual, residual)
+    candidate_norm = np.sqrt(max(d_norm * d_norm - d_window_squared, 0.0) + residual_squared)
+    if d_norm + candidate_norm == 0:
+        return 0.0
+    return float((d_window_squared - residual_squared) / (d_norm + candidate_norm))
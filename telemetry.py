@@ -0,0 +1,195 @@
+# Copyright 2023 University of Twente
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import atexit
+import json
+import queue
+import threading
+from typing import Callable
+
+import numpy as np
+
+
+class IterationTelemetry:
+    """
+    Measurements of a single iteration of ProfileSteering.iterative
+    """
+    __slots__ = ('iteration', 'winner', 'winners', 'improvement', 'objective', 'time', 'plan_time',
+                 'plan_latencies', 'plan_calls', 'aggregation_time', 'decryption_time')
+
+    def __init__(self, iteration, winner, winners, improvement, objective, time, plan_time, plan_latencies,
+                 plan_calls, aggregation_time, decryption_time):
+        self.iteration = iteration  # index of the iteration
+        self.winner = winner  # device with the best improvement, None if there is no improvement
+        self.winners = winners  # all devices that accepted their candidate
+        self.improvement = improvement  # improvement of the winner
+        self.objective = objective  # ||x - p|| after the update
+        self.time = time  # wall time of the iteration in seconds
+        self.plan_time = plan_time  # wall time spent on planning in seconds
+        # plan time in seconds per planned device, keyed on the index in ProfileSteering.devices.
+        # With batched planning the time of a batch is spread evenly over its devices.
+        self.plan_latencies = plan_latencies
+        self.plan_calls = plan_calls  # number of devices planned in this iteration
+        self.aggregation_time = aggregation_time  # wall time spent on updating the aggregate in seconds
+        self.decryption_time = decryption_time  # wall time spent on decrypting the aggregate in seconds
+
+
+class SteeringObserver:
+    """
+    Receives the telemetry of a ProfileSteering instance, override the methods of interest.
+    """
+
+    def on_init(self, aggregation_time: float, decryption_time: float) -> None:
+        """
+        Called at the end of ProfileSteering.init, and of ProfileSteering.advance
+        :param aggregation_time: wall time spent on aggregating the profiles in seconds
+        :param decryption_time: wall time spent on decrypting the aggregate in seconds
+        :return: None
+        """
+        pass
+
+    def on_iteration(self, telemetry: IterationTelemetry) -> None:
+        """
+        Called at the end of every iteration of ProfileSteering.iterative
+        :param telemetry: measurements of the iteration
+        :return: None
+        """
+        pass
+
+    def on_finish(self, iterations: int, objective: float, wall_time: float) -> None:
+        """
+        Called at the end of ProfileSteering.iterative
+        :param iterations: number of iterations
+        :param objective: ||x - p|| of the final profile
+        :param wall_time: wall time of the iterative phase in seconds
+        :return: None
+        """
+        pass
+
+
+class PrintObserver(SteeringObserver):
+    """
+    Prints a line per iteration, like the algorithm used to do by itself
+    """
+
+    def on_iteration(self, telemetry: IterationTelemetry) -> None:
+        print("Iteration", telemetry.iteration, "-- Winner", telemetry.winner, "Winners", len(telemetry.winners),
+              "Improvement", telemetry.improvement, "Objective", round(telemetry.objective, 5),
+              "Time", round(telemetry.time, 5))
+
+    def on_finish(self, iterations: int, objective: float, wall_time: float) -> None:
+        print("Iterations", iterations, "-- Objective", round(objective, 5), "Time", round(wall_time, 5))
+
+
+def privacy_statistics(real_sum: np.ndarray, noisy_sum: np.ndarray) -> dict:
+    """
+    Effect of the noise of differential privacy on the aggregate
+    :param real_sum: sum of the real profiles
+    :param noisy_sum: sum of the noisy profiles
+    :return: error per interval (noisy - real), RMS error and maximum absolute deviation
+    """
+    error = np.subtract(noisy_sum, real_sum)
+    return {
+        "error": error.tolist(),
+        "rms_error": float(np.sqrt(np.mean(np.square(error)))) if len(error) else 0.0,
+        "max_deviation": float(np.max(np.abs(error))) if len(error) else 0.0,
+    }
+
+
+class PrivacyDiagnostics:
+    """
+    Receives the real and the noisy aggregate of the differential privacy backend, override on_aggregate.
+    The backend only keeps the real profiles when diagnostics are enabled.
+    """
+
+    def on_aggregate(self, real_sum: np.ndarray, noisy_sum: np.ndarray) -> None:
+        """
+        Called when the backend aggregates the initial profiles
+        :param real_sum: sum of the real profiles
+        :param noisy_sum: sum of the noisy profiles
+        :return: None
+        """
+        pass
+
+
+class _BackgroundDiagnostics(PrivacyDiagnostics):
+    """
+    Computes and handles the statistics of every aggregate in a background thread, such that the aggregation does not
+    wait for it. The remaining statistics are handled at close, which is also called at exit.
+    """
+
+    def __init__(self):
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+
+    def _handle(self, statistics: dict) -> None:
+        """
+        Handles the statistics of an aggregate, in the background thread
+        :param statistics: see privacy_statistics
+        :return: None
+        """
+        pass
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            self._handle(privacy_statistics(*item))
+
+    def on_aggregate(self, real_sum: np.ndarray, noisy_sum: np.ndarray) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+        self._queue.put((np.array(real_sum), np.array(noisy_sum)))
+
+    def close(self) -> None:
+        """
+        Waits until the statistics of all aggregates are handled
+        :return: None
+        """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+            atexit.unregister(self.close)
+
+
+class CallbackDiagnostics(_BackgroundDiagnostics):
+    """
+    Passes the statistics of every aggregate to a callback, see privacy_statistics.
+    The callback is called from a background thread.
+    """
+
+    def __init__(self, callback: Callable[[dict], None]):
+        super().__init__()
+        self.callback = callback
+
+    def _handle(self, statistics: dict) -> None:
+        self.callback(statistics)
+
+
+class FileDiagnostics(_BackgroundDiagnostics):
+    """
+    Appends the statistics of every aggregate as a JSON line to a file, see privacy_statistics
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+
+    def _handle(self, statistics: dict) -> None:
+        with open(self.path, "a") as f:
+            f.write(json.dumps(statistics) + "\n")